@@ -1,4 +1,6 @@
-from clicktrack import gui
+import signal
+
+from clicktrack.trace import Tracer, DEFAULT_THRESHOLD
 
 """
 
@@ -10,5 +12,24 @@ def run(argv=[]):
 		window_mode = 'windowed'
 	elif '-f' in argv:
 		window_mode = 'fullscreen'
-	g = gui.MainUI()
+	engine = 'thread'
+	if '-i' in argv:
+		engine = 'isolated'
+	elif '-a' in argv:
+		engine = 'asyncio'
+	elif '-s' in argv:
+		engine = 'sequencer'
+	capture_path = None
+	if '-c' in argv and argv.index('-c') + 1 < len(argv):
+		capture_path = argv[argv.index('-c') + 1]
+	control = '-r' in argv
+	tracer = None
+	if '-T' in argv:
+		# dump on late ticks, and whenever we get SIGUSR1
+		tracer = Tracer(threshold=DEFAULT_THRESHOLD)
+		signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.request_dump())
+	# imported here so that the command line tools (benchmark, stress, capture)
+	# can be run without PyQt
+	from clicktrack import gui
+	g = gui.MainUI(engine=engine, capture_path=capture_path, control=control, tracer=tracer)
 	g.run(window_mode=window_mode)
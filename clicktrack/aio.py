@@ -0,0 +1,313 @@
+import asyncio
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from clicktrack import audio
+from clicktrack import voices
+from clicktrack.dispatcher import (ClickRouter, TimedDispatcher,
+	MIDIInputDispatcher, MultiInputDispatcher, FailoverDispatcher,
+	ReplayDispatcher, PPQN,
+	MSG_CLOCK_BEAT, TRANSPORT_MESSAGES)
+
+"""
+Event loop based click engine.
+
+The threaded ClickRouter runs one OS thread per MIDI output, plus one each for
+the audible click, the GUI callback and the dispatcher, so the thread count and
+number of context switches per tick grow with the number of ports.
+
+AsyncClickRouter keeps the same API but runs the timer, the fan-out and every
+consumer as tasks on a single asyncio event loop in one thread. MIDI output
+writes are made directly from the loop since rtmidi only hands the message to
+the sequencer, and clicks are handed to the standby audio device (see
+audio.py) without blocking. Only opening the device and rendering the click
+go to a (small) executor.
+"""
+
+"""
+Once the deadline is closer than this, the timer stops yielding to the event
+loop and sleeps the rest of the way itself. The selector only has millisecond
+resolution, so yielding any closer would make us late.
+"""
+SPIN_THRESHOLD = 0.0015
+
+class AsyncClickRouter(ClickRouter):
+	loop = None
+	engine = None
+	executor = None
+	consumers = []
+	ports = []
+	# whether this run has a sound consumer, see _open_sound()
+	sound_task = False
+	schedule = None
+	voice = None
+	device = None
+	callback = None
+	deadline = 0.0
+	interval = 60.0 / 120.0 / 24.0
+	running = False
+
+	def __init__(self, backend=None):
+		super(AsyncClickRouter, self).__init__(backend)
+		self.ports = []
+		self.consumers = []
+
+	def init(self, callback=None):
+		self._open_outputs()
+		if self.sound:
+			self._open_sound()
+		self.callback = callback
+		self.interval = 60.0 / self.tempo / 24.0
+
+		# The timed dispatcher is replaced by a task on the loop; anything else
+		# (i.e. MIDI input) still gets its own thread which hands events over
+		# to the loop.
+		if self.backend is not TimedDispatcher:
+			self.dispatcher = self.backend(self._click_threadsafe)
+			if isinstance(self.dispatcher, ReplayDispatcher):
+				self.dispatcher.set_replay(self.replay, self.replay_fast)
+			elif isinstance(self.dispatcher, MultiInputDispatcher):
+				self.dispatcher.set_input_ports(self.input_ports, self.clock_input)
+				self.dispatcher.set_capture(self.capture)
+				outputs = {}
+				for (index, port) in self.ports:
+					outputs[index] = AsyncRouteOutput(self, port)
+				self.dispatcher.set_routes(self.routes, outputs)
+				if isinstance(self.dispatcher, FailoverDispatcher):
+					self.dispatcher.set_failover(self.failover_ticks, self.state_listener)
+			elif isinstance(self.dispatcher, MIDIInputDispatcher):
+				self.dispatcher.set_input_port(self.input_port)
+				self.dispatcher.set_capture(self.capture)
+
+	def _add_output(self, midi_out, index):
+		self.ports.append((index, midi_out))
+
+	def _open_sound(self):
+		self.sound_task = True
+
+	def get_drops(self):
+		return dict(self.drops)
+
+	"""
+	Dispatches a click event to every consumer. Runs on the event loop thread.
+	"""
+	def click(self, msg='click'):
+		while self.deferred:
+			self.deferred.popleft()()
+
+		if msg == 'click':
+			song = self.next_song
+			new_bar = song and (self.ticks - self.bar_origin) % (PPQN * self._beats()) == 0
+			if new_bar:
+				self._change_song(song)
+			if not self.announced:
+				self.announced = True
+				for queue in self.consumers:
+					queue.put_nowait('start')
+			self.ticks += 1
+			if new_bar:
+				self.bar_origin = self.ticks - 1
+				for queue in self.consumers:
+					queue.put_nowait('bar')
+		elif msg == 'start':
+			self.ticks = 0
+			self.bar_origin = 0
+			self.announced = True
+
+		for queue in self.consumers:
+			queue.put_nowait(msg)
+
+	def get_phase(self):
+		if self.dispatcher or not self.ticks:
+			return super(AsyncClickRouter, self).get_phase()
+		return (self.ticks, self.deadline, self.interval)
+
+	def retime(self, tempo):
+		song = self.next_song
+		if song:
+			self.next_song = (tempo,) + song[1:]
+			return
+
+		self.tempo = tempo
+		self.defer(self._apply_tempo)
+
+	def _apply_tempo(self):
+		self.interval = 60.0 / self.tempo / 24.0
+
+	def _click_threadsafe(self, msg='click'):
+		self.loop.call_soon_threadsafe(self.click, msg)
+
+	def start(self, callback=None):
+		self.init(callback)
+		self.ticks = 0
+		self.bar_origin = 0
+		self.announced = False
+		self.next_song = None
+
+		self.loop = asyncio.new_event_loop()
+		self.executor = ThreadPoolExecutor(max_workers=1)
+		self.running = True
+
+		self.engine = threading.Thread(target=self._run_loop)
+		ready = threading.Event()
+		self.loop.call_soon(ready.set)
+		self.engine.start()
+		ready.wait()
+
+		if self.dispatcher:
+			self.dispatcher.start()
+
+		self.started = True
+
+	def _run_loop(self):
+		asyncio.set_event_loop(self.loop)
+		tasks = []
+		for (index, port) in self.ports:
+			tasks.append(self._output(port, self._new_consumer()))
+
+		if self.sound_task:
+			tasks.append(self._sound(self._new_consumer()))
+
+		if self.callback:
+			tasks.append(self._callback(self._new_consumer()))
+
+		if not self.dispatcher:
+			tasks.append(self._timer())
+
+		self.loop.run_until_complete(asyncio.gather(*tasks))
+		self.loop.close()
+
+	def _new_consumer(self):
+		queue = asyncio.Queue()
+		self.consumers.append(queue)
+		return queue
+
+	def stop(self):
+		if self.dispatcher:
+			self.dispatcher.stop()
+
+		self.loop.call_soon_threadsafe(self._shutdown)
+		self.engine.join()
+		self.executor.shutdown()
+
+		self.ports = []
+		self.consumers = []
+		self.sound_task = False
+		self.dispatcher = None
+		self.engine = None
+		self.loop = None
+
+		self.started = False
+
+	def _shutdown(self):
+		self.running = False
+		self.click('stop')
+
+	def set_tempo(self, tempo, multiplier=1):
+		self.tempo = tempo
+		self.interval = 60.0 / tempo / 24.0
+		self.next_song = None
+		if multiplier != self.multiplier:
+			self.multiplier = multiplier
+			pattern = self.pattern if self.pattern else voices.ClickPattern()
+			self.set_pattern(voices.ClickPattern(pattern.beats, multiplier))
+
+	def set_pattern(self, pattern):
+		self.pattern = pattern
+		if self.voice and self.device:
+			self._compile()
+
+	def _compile(self):
+		pattern = self.pattern if self.pattern else voices.ClickPattern(subdivision=self.multiplier)
+		self.schedule = voices.ClickSchedule(pattern, self.voice, *self.device.config())
+
+	"""
+	Same deadline arithmetic as HrTimer, but yields to the event loop while
+	there is time to spare.
+	"""
+	async def _timer(self):
+		last = time.monotonic()
+		self.deadline = last
+		self.click()
+		while self.running:
+			deadline = last + self.interval
+			rem = deadline - time.monotonic()
+			if rem > SPIN_THRESHOLD:
+				await asyncio.sleep(rem - SPIN_THRESHOLD)
+				continue
+
+			if rem > 0:
+				time.sleep(rem)
+
+			self.deadline = deadline
+			self.click()
+			last = deadline
+
+			# let the consumers run before the next deadline
+			await asyncio.sleep(0)
+
+	async def _output(self, port, queue):
+		while True:
+			msg = await queue.get()
+			if msg == 'click':
+				port.send_message([MSG_CLOCK_BEAT])
+			elif msg in TRANSPORT_MESSAGES:
+				port.send_message([TRANSPORT_MESSAGES[msg]])
+				if msg == 'stop':
+					return
+
+	async def _sound(self, queue):
+		if not self.voice:
+			self.voice = await self.loop.run_in_executor(self.executor,
+				voices.default_voice)
+		try:
+			device = await self.loop.run_in_executor(self.executor, audio.standby)
+		except audio.AudioError as e:
+			sys.stderr.write("%s, no audible click\n" % (e.message))
+			device = None
+
+		if device:
+			voices.voice_cache.configure(*device.config())
+			self.device = device
+			await self.loop.run_in_executor(self.executor, self._compile)
+			device.resume()
+
+		i = 0
+		while True:
+			msg = await queue.get()
+			if msg == 'click':
+				data = self.schedule.at(i) if device else None
+				if data:
+					device.play(data)
+
+				i += 1
+			elif msg in ('start', 'bar'):
+				i = 0
+			elif msg == 'stop':
+				if device:
+					device.pause()
+				return
+
+	async def _callback(self, queue):
+		while True:
+			msg = await queue.get()
+			if msg == 'click':
+				# every click is queued on its own here, so there is
+				# nothing to coalesce
+				self.callback(1)
+			elif msg == 'stop':
+				return
+
+"""
+Routing target for the multi-input dispatcher. Routed messages are sent from
+the event loop, in arrival order with the clock.
+"""
+class AsyncRouteOutput:
+	def __init__(self, router, port):
+		self.router = router
+		self.port = port
+
+	def route(self, message):
+		self.router.loop.call_soon_threadsafe(self.port.send_message, message)
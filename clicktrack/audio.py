@@ -0,0 +1,235 @@
+import sys
+import threading
+from collections import deque
+
+import alsaaudio
+
+from clicktrack import voices
+
+"""
+Warm-standby audio output for the audible click.
+
+Opening and configuring a PCM device takes a while, and a device that is left
+to run dry underruns and has to be restarted and refilled before the next
+sound comes out. So the device is opened once per process, and while a clock
+is running a writer thread keeps it playing silence whenever there is no
+click to play. Playing a click only hands a ready-made buffer to the writer,
+which plays it instead of the next period of silence; the click is heard one
+device buffer after that, every time.
+
+Feeding small periods wakes the writer hundreds of times a second, so it
+only runs between resume() and pause(), which the click workers call when the
+clock starts and stops. While paused the device is paused too where the
+driver allows it, and otherwise left to underrun; either way the first write
+after resume() gets it going again well within the start lead.
+
+The device format is negotiated rather than imposed: ALSA is asked for each
+of the preferred rates, formats and channel counts in turn and the answer is
+used as it comes back (voices.py renders the click to match), and the period
+is the smallest one the driver accepts, since it bounds the click latency.
+"""
+
+# preferences, best first
+AUDIO_RATES = (48000, 44100)
+AUDIO_FORMATS = (voices.FORMAT_S16_LE, voices.FORMAT_S32_LE, voices.FORMAT_U8)
+AUDIO_CHANNELS = 1
+PERIOD_SIZE = 64
+
+PCM_FORMATS = {
+	voices.FORMAT_U8: alsaaudio.PCM_FORMAT_U8,
+	voices.FORMAT_S16_LE: alsaaudio.PCM_FORMAT_S16_LE,
+	voices.FORMAT_S32_LE: alsaaudio.PCM_FORMAT_S32_LE,
+}
+
+"""
+An open playback device and the thread that keeps it fed.
+"""
+class AudioDevice(threading.Thread):
+	pcm = None
+	rate = 0
+	format = None
+	channels = 0
+	period = 0
+	quit = False
+
+	def __init__(self):
+		super(AudioDevice, self).__init__(name='audio')
+		self.daemon = True
+		# only the latest click is kept; one that hasn't started playing by
+		# the time the next arrives is too late to be worth hearing
+		self.queued = deque(maxlen=1)
+		# set while anyone has the device resumed
+		self.running = threading.Event()
+		self.users = 0
+		self.lock = threading.Lock()
+
+	"""
+	Open the default device, negotiate its configuration and start keeping
+	it busy with silence.
+	"""
+	def open(self):
+		try:
+			self.pcm = alsaaudio.PCM()
+			self._negotiate()
+		except alsaaudio.ALSAAudioError as e:
+			if self.pcm:
+				self.pcm.close()
+			raise AudioError("Cannot open the audio device: %s" % (e))
+
+		# one period of silence
+		self.silence = voices.encode([0.0] * self.period, self.format, self.channels)
+		self.start()
+
+	def _negotiate(self):
+		pcm = self.pcm
+		self.channels = pcm.setchannels(AUDIO_CHANNELS) or AUDIO_CHANNELS
+
+		for rate in AUDIO_RATES:
+			actual = pcm.setrate(rate)
+			self.rate = actual if actual else rate
+			if self.rate == rate:
+				break
+
+		for fmt in AUDIO_FORMATS:
+			try:
+				pcm.setformat(PCM_FORMATS[fmt])
+			except alsaaudio.ALSAAudioError:
+				continue
+			self.format = fmt
+			break
+		else:
+			raise alsaaudio.ALSAAudioError("none of %s is supported" % (', '.join(AUDIO_FORMATS)))
+
+		# the driver rounds this up to the smallest period it can do
+		self.period = pcm.setperiodsize(PERIOD_SIZE) or PERIOD_SIZE
+
+	"""
+	Returns (rate, format, channels), the arguments voices.py renders for.
+	"""
+	def config(self):
+		return (self.rate, self.format, self.channels)
+
+	"""
+	Play a buffer in the device's format as soon as possible, cutting off
+	whatever click is still playing. Never blocks.
+	"""
+	def play(self, data):
+		self.queued.append(data)
+
+	"""
+	Keep the device playing, for a clock that is about to start. Calls nest,
+	so several clocks can share the device.
+	"""
+	def resume(self):
+		with self.lock:
+			self.users += 1
+			self.running.set()
+
+	"""
+	Undo a resume(). The writer goes to sleep once nobody needs the device.
+	"""
+	def pause(self):
+		with self.lock:
+			self.users = max(0, self.users - 1)
+			if not self.users:
+				self.running.clear()
+
+	def run(self):
+		pcm = self.pcm
+		silence = self.silence
+		size = len(silence)
+		current = None
+		pos = 0
+
+		try:
+			while not self.quit:
+				if not self.running.is_set():
+					self._idle()
+					continue
+
+				if self.queued:
+					current = self.queued.popleft()
+					pos = 0
+
+				if current is None:
+					chunk = silence
+				else:
+					chunk = current[pos:pos + size]
+					pos += size
+					if pos >= len(current):
+						current = None
+						if len(chunk) < size:
+							chunk += silence[len(chunk):]
+
+				# blocks until the device has room for a period
+				pcm.write(chunk)
+		except alsaaudio.ALSAAudioError as e:
+			sys.stderr.write("Audio device failed: %s\n" % (e))
+		finally:
+			pcm.close()
+
+	def _idle(self):
+		pcm = self.pcm
+		self.queued.clear()
+		try:
+			pcm.pause(1)
+			paused = True
+		except alsaaudio.ALSAAudioError:
+			# not every driver can pause; an underrun does no harm either
+			paused = False
+
+		# close() sets this too
+		self.running.wait()
+
+		if paused:
+			try:
+				pcm.pause(0)
+			except alsaaudio.ALSAAudioError:
+				pass
+
+	def close(self):
+		self.quit = True
+		self.running.set()
+		self.join()
+
+_standby = None
+_standby_lock = threading.Lock()
+
+"""
+The process's standby device, opened on first use. A device whose writer has
+died is replaced.
+"""
+def standby():
+	global _standby
+	with _standby_lock:
+		if _standby is None or not _standby.is_alive():
+			device = AudioDevice()
+			device.open()
+			_standby = device
+
+		return _standby
+
+"""
+Open the standby device and render the default click for it in the
+background, so that starting the clock finds both ready.
+"""
+def prepare():
+	thread = threading.Thread(target=_prepare, name='audio prepare')
+	thread.daemon = True
+	thread.start()
+
+def _prepare():
+	try:
+		device = standby()
+	except AudioError as e:
+		sys.stderr.write("%s\n" % (e.message))
+		return
+
+	voices.voice_cache.configure(*device.config())
+	voices.voice_cache.get(voices.default_voice(), *device.config())
+
+class AudioError(Exception):
+	message = ''
+	def __init__(self, message):
+		super(self.__class__, self).__init__()
+		self.message = message
@@ -0,0 +1,307 @@
+import sys
+import threading
+import time
+import argparse
+
+from clicktrack.dispatcher import (ClickRouter, ReplayDispatcher,
+	DomainDispatcher, DomainScheduler, MSG_CLOCK_BEAT, MSG_CLOCK_START,
+	MSG_CLOCK_STOP)
+from clicktrack.aio import AsyncClickRouter
+from clicktrack.capture import ClockCapture
+from clicktrack.master import TempoDetector, ClickMasterError
+
+"""
+Benchmark harness for the click engines.
+
+Runs each engine against a number of fake MIDI output ports (no hardware or
+audio device is touched) and reports how late the clock bytes leave each port
+relative to the ideal tick grid, how long the timer spends per tick, and how
+many threads the engine needs. The start and stop skew are the spread, across
+ports, of the times the start (together with the first clock) and stop
+messages went out.
+
+With -c, each engine runs in thru mode instead, replaying a clock capture (see
+capture.py) in real time, and the latency is measured from the moment each
+clock is received. The capture is also run through TempoDetector.
+
+With -D, a number of clock domains (one router each, every other one at half
+the tempo) run at once, first each on its own TimedDispatcher and then all on
+one DomainScheduler.
+
+Usage: python3 -m clicktrack.benchmark [-p PORTS] [-t TEMPO] [-d SECONDS]
+	[-c CAPTURE] [-D DOMAINS]
+"""
+
+"""
+Stand-in for an rtmidi.MidiOut that records when each message was sent.
+"""
+class FakePort:
+	def __init__(self):
+		self.times = []
+		self.messages = []
+
+	def send_message(self, message):
+		self.times.append(time.monotonic())
+		self.messages.append(message[0])
+
+	def beat_times(self):
+		return [t for (t, m) in zip(self.times, self.messages) if m == MSG_CLOCK_BEAT]
+
+	"""
+	Time the given message was first sent at, or None.
+	"""
+	def first(self, status):
+		for (t, m) in zip(self.times, self.messages):
+			if m == status:
+				return t
+		return None
+
+"""
+Spread of the times the start message and the first clock left the ports, and
+of the times the stop message did.
+"""
+def transport_skew(ports):
+	starts = []
+	stops = []
+	for port in ports:
+		for status in (MSG_CLOCK_START, MSG_CLOCK_BEAT):
+			t = port.first(status)
+			if t is not None:
+				starts.append(t)
+		t = port.first(MSG_CLOCK_STOP)
+		if t is not None:
+			stops.append(t)
+
+	return (max(starts) - min(starts) if starts else 0.0,
+		max(stops) - min(stops) if stops else 0.0)
+
+"""
+Mixin which replaces the real MIDI/audio outputs of a router with fake ports
+and records the timer's cost per tick.
+"""
+class BenchmarkMixin:
+	num_ports = 0
+	fake_ports = []
+	tick_costs = []
+	tick_times = []
+	first_tick = None
+
+	def _open_outputs(self):
+		self.fake_ports = []
+		self.tick_costs = []
+		self.tick_times = []
+		self.first_tick = None
+		for i in range(0, self.num_ports):
+			port = FakePort()
+			self.fake_ports.append(port)
+			self._add_output(port, i)
+
+	def _open_sound(self):
+		pass
+
+	def click(self, msg='click'):
+		t = time.monotonic()
+		if self.first_tick is None:
+			self.first_tick = t
+		if msg == 'click':
+			self.tick_times.append(t)
+		super(BenchmarkMixin, self).click(msg)
+		self.tick_costs.append(time.monotonic() - t)
+
+class ThreadedBenchmarkRouter(BenchmarkMixin, ClickRouter):
+	pass
+
+class AsyncBenchmarkRouter(BenchmarkMixin, AsyncClickRouter):
+	pass
+
+class DomainBenchmarkRouter(BenchmarkMixin, ClickRouter):
+	def __init__(self):
+		super(DomainBenchmarkRouter, self).__init__(DomainDispatcher)
+
+ENGINES = [
+	('thread', ThreadedBenchmarkRouter),
+	('asyncio', AsyncBenchmarkRouter),
+]
+
+def percentile(values, p):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+"""
+Run one engine and return a dict of results. Latencies are in seconds.
+
+Without a capture the latency is measured against the ideal tick grid; with
+one, against the time each replayed clock was received.
+"""
+def run_engine(router_class, num_ports, tempo, duration, capture=None):
+	if capture:
+		router = router_class(ReplayDispatcher)
+		router.set_replay(capture)
+	else:
+		router = router_class()
+	router.num_ports = num_ports
+	router.set_tempo(tempo)
+
+	baseline_threads = threading.active_count()
+	router.start()
+	time.sleep(duration / 2.0)
+	threads = threading.active_count() - baseline_threads
+	time.sleep(duration / 2.0)
+	router.stop()
+
+	interval = 60.0 / tempo / 24.0
+	latencies = []
+	for port in router.fake_ports:
+		for (k, t) in enumerate(port.beat_times()):
+			if capture:
+				latencies.append(t - router.tick_times[k])
+			else:
+				latencies.append(t - (router.first_tick + k * interval))
+
+	(start_skew, stop_skew) = transport_skew(router.fake_ports)
+
+	return {
+		'start_skew': start_skew,
+		'stop_skew': stop_skew,
+		'threads': threads,
+		'ticks': len(router.tick_costs),
+		'latency_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+		'latency_p99': percentile(latencies, 99),
+		'latency_max': max(latencies) if latencies else 0.0,
+		'tick_cost_mean': sum(router.tick_costs) / len(router.tick_costs),
+		'tick_cost_p99': percentile(router.tick_costs, 99),
+	}
+
+"""
+Run a number of clock domains at once, each with its own ports, and return a
+dict of results. The latency of each domain is measured against its own tick
+grid.
+
+@param bool
+	Share one DomainScheduler between the domains instead of giving each a
+	TimedDispatcher
+"""
+def run_domains(num_domains, num_ports, tempo, duration, shared):
+	scheduler = DomainScheduler() if shared else None
+	routers = []
+	for i in range(0, num_domains):
+		if shared:
+			router = DomainBenchmarkRouter()
+			router.set_scheduler(scheduler)
+		else:
+			router = ThreadedBenchmarkRouter()
+		router.num_ports = num_ports
+		router.set_tempo(tempo / 2.0 if i % 2 else tempo)
+		routers.append(router)
+
+	baseline_threads = threading.active_count()
+	for router in routers:
+		router.start()
+	time.sleep(duration / 2.0)
+	# the ports' worker threads aren't what this is about
+	threads = threading.active_count() - baseline_threads - \
+		num_domains * num_ports
+	time.sleep(duration / 2.0)
+	for router in routers:
+		router.stop()
+
+	latencies = []
+	costs = []
+	ticks = 0
+	for router in routers:
+		interval = 60.0 / router.tempo / 24.0
+		for port in router.fake_ports:
+			for (k, t) in enumerate(port.beat_times()):
+				latencies.append(t - (router.first_tick + k * interval))
+		costs.extend(router.tick_costs)
+		ticks += len(router.tick_costs)
+
+	return {
+		'threads': threads,
+		'ticks': ticks,
+		'latency_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+		'latency_p99': percentile(latencies, 99),
+		'latency_max': max(latencies) if latencies else 0.0,
+		'tick_cost_mean': sum(costs) / len(costs) if costs else 0.0,
+		'tick_cost_p99': percentile(costs, 99),
+	}
+
+def print_results(name, result):
+	line = "%-10s threads=%-3d ticks=%-6d latency mean=%7.1fus p99=%7.1fus max=%7.1fus  tick cost mean=%6.1fus p99=%6.1fus" % (
+		name, result['threads'], result['ticks'],
+		result['latency_mean'] * 1e6, result['latency_p99'] * 1e6,
+		result['latency_max'] * 1e6,
+		result['tick_cost_mean'] * 1e6, result['tick_cost_p99'] * 1e6)
+	if 'start_skew' in result:
+		line += "  skew start=%6.1fus stop=%6.1fus" % (result['start_skew'] * 1e6,
+			result['stop_skew'] * 1e6)
+	print(line)
+
+"""
+Feed every clock of a capture through TempoDetector, using the captured
+timestamps, and report the cost per clock and the spread of the estimates.
+"""
+def run_detector(capture):
+	detector = TempoDetector()
+	detector.beats = []
+	estimates = []
+	costs = []
+	for (status, delta, stamp) in capture.events():
+		if status != MSG_CLOCK_BEAT:
+			continue
+		t = time.monotonic()
+		detector.beat(1, stamp)
+		try:
+			estimates.append(detector.get_tempo())
+		except ClickMasterError:
+			pass
+		costs.append(time.monotonic() - t)
+
+	if not estimates:
+		return
+
+	stats = capture.clock_stats()
+	print("TempoDetector: capture tempo=%.2f bpm, estimates min=%.2f max=%.2f last=%.2f, cost mean=%.1fus p99=%.1fus" % (
+		stats['tempo'], min(estimates), max(estimates), estimates[-1],
+		sum(costs) / len(costs) * 1e6, percentile(costs, 99) * 1e6))
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the click engines.')
+	parser.add_argument('-p', '--ports', type=int, action='append',
+		help='number of fake output ports (may be repeated)')
+	parser.add_argument('-t', '--tempo', type=float, default=120.0)
+	parser.add_argument('-d', '--duration', type=float, default=10.0,
+		help='seconds to run each engine for')
+	parser.add_argument('-c', '--capture',
+		help='replay this clock capture in thru mode')
+	parser.add_argument('-D', '--domains', type=int, action='append',
+		help='run this many clock domains at once (may be repeated)')
+	args = parser.parse_args(argv)
+
+	if args.domains:
+		num_ports = args.ports[0] if args.ports else 2
+		for num_domains in args.domains:
+			print("== %d domains of %d ports, %.1f/%.1f bpm, %.1fs" % (num_domains,
+				num_ports, args.tempo, args.tempo / 2.0, args.duration))
+			for (name, shared) in (('timers', False), ('scheduler', True)):
+				print_results(name, run_domains(num_domains, num_ports, args.tempo,
+					args.duration, shared))
+		return 0
+
+	capture = ClockCapture.load(args.capture) if args.capture else None
+	if capture:
+		run_detector(capture)
+
+	for num_ports in (args.ports or [2, 8, 32]):
+		print("== %d ports, %.1f bpm, %.1fs%s" % (num_ports, args.tempo,
+			args.duration, ' (thru)' if capture else ''))
+		for (name, router_class) in ENGINES:
+			print_results(name, run_engine(router_class, num_ports, args.tempo,
+				args.duration, capture))
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,225 @@
+import array
+import struct
+import sys
+import time
+import argparse
+
+"""
+Timestamped MIDI clock capture.
+
+A ClockCapture is a fixed size ring buffer of incoming realtime messages. Each
+event stores the status byte, rtmidi's delta_time and a time.monotonic() stamp
+in preallocated arrays, so recording an event never grows a list or builds a
+tuple and is cheap enough to leave running during a show. Once full, the
+oldest events are overwritten.
+
+Captures are saved in a compact binary format: a header followed by the three
+arrays in chronological order.
+
+A saved capture can be fed back through a ClickRouter with ReplayDispatcher
+(see dispatcher.py), and this module doubles as a command line tool to record,
+inspect and replay captures:
+
+	python3 -m clicktrack.capture record PORT FILE [-d SECONDS]
+	python3 -m clicktrack.capture info FILE
+	python3 -m clicktrack.capture replay FILE [--fast]
+"""
+
+MAGIC = b'PCTC'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')
+
+# about three and a half hours of clock at 200bpm (80 ticks a second), in
+# 17 bytes per event, i.e. about 18MB allocated up front
+DEFAULT_CAPACITY = 1 << 20
+
+class ClockCapture:
+	capacity = DEFAULT_CAPACITY
+	count = 0
+
+	def __init__(self, capacity=DEFAULT_CAPACITY):
+		self.capacity = capacity
+		self.count = 0
+		self.status = array.array('B', bytes(capacity))
+		self.delta = array.array('d', [0.0]) * capacity
+		self.stamp = array.array('d', [0.0]) * capacity
+
+	"""
+	Record one event. Called from the MIDI input callback.
+	"""
+	def record(self, status, delta_time, stamp):
+		i = self.count % self.capacity
+		self.status[i] = status
+		self.delta[i] = delta_time
+		self.stamp[i] = stamp
+		self.count += 1
+
+	def __len__(self):
+		return min(self.count, self.capacity)
+
+	"""
+	Index of the oldest event still held in the ring.
+	"""
+	def _first(self):
+		return self.count % self.capacity if self.count > self.capacity else 0
+
+	"""
+	Iterate over (status, delta_time, stamp) tuples in chronological order.
+	"""
+	def events(self):
+		first = self._first()
+		for n in range(0, len(self)):
+			i = (first + n) % self.capacity
+			yield (self.status[i], self.delta[i], self.stamp[i])
+
+	def _ordered(self, arr):
+		first = self._first()
+		if self.count > self.capacity:
+			return arr[first:] + arr[:first]
+		return arr[:self.count]
+
+	def save(self, path):
+		with open(path, 'wb') as f:
+			f.write(HEADER.pack(MAGIC, VERSION, 0, len(self)))
+			for arr in (self.stamp, self.delta):
+				arr = self._ordered(arr)
+				if sys.byteorder == 'big':
+					arr.byteswap()
+				arr.tofile(f)
+			self._ordered(self.status).tofile(f)
+
+	@classmethod
+	def load(cls, path):
+		with open(path, 'rb') as f:
+			(magic, version, flags, count) = HEADER.unpack(f.read(HEADER.size))
+			if magic != MAGIC or version != VERSION:
+				raise CaptureError("%s is not a clock capture" % (path))
+
+			if count == 0:
+				return cls(1)
+
+			capture = cls(count)
+			for arr in (capture.stamp, capture.delta):
+				del arr[:]
+				arr.fromfile(f, count)
+				if sys.byteorder == 'big':
+					arr.byteswap()
+			del capture.status[:]
+			capture.status.fromfile(f, count)
+			capture.count = count
+
+		return capture
+
+	"""
+	Summary statistics of the 0xF8 clock intervals, in seconds.
+	"""
+	def clock_stats(self):
+		last = None
+		intervals = []
+		for (status, delta, stamp) in self.events():
+			if status != 0xF8:
+				continue
+			if last is not None:
+				intervals.append(stamp - last)
+			last = stamp
+
+		if not intervals:
+			return None
+
+		mean = sum(intervals) / len(intervals)
+		intervals.sort()
+		return {
+			'clocks': len(intervals) + 1,
+			'mean': mean,
+			'tempo': 60.0 / mean / 24.0,
+			'min': intervals[0],
+			'max': intervals[-1],
+			'p99': intervals[min(len(intervals) - 1, int(len(intervals) * 0.99))],
+			'jitter': (sum((x - mean) ** 2 for x in intervals) / len(intervals)) ** 0.5,
+		}
+
+class CaptureError(Exception):
+	message = ''
+	def __init__(self, message):
+		super(self.__class__, self).__init__()
+		self.message = message
+
+def _record(args):
+	import rtmidi
+	from clicktrack.dispatcher import MIDIInputDispatcher
+
+	midi_in = rtmidi.MidiIn()
+	for i in range(0, midi_in.get_port_count()):
+		if args.port in midi_in.get_port_name(i):
+			midi_in.open_port(i)
+			break
+	else:
+		raise CaptureError("No MIDI input matching %s" % (args.port))
+
+	capture = ClockCapture()
+	dispatcher = MIDIInputDispatcher(lambda msg='click': None)
+	dispatcher.set_input_port(midi_in)
+	dispatcher.set_capture(capture)
+	dispatcher.start()
+	try:
+		time.sleep(args.duration)
+	except KeyboardInterrupt:
+		pass
+	dispatcher.stop()
+	capture.save(args.file)
+	print("Captured %d events to %s" % (len(capture), args.file))
+
+def _info(args):
+	capture = ClockCapture.load(args.file)
+	print("%d events" % (len(capture)))
+	stats = capture.clock_stats()
+	if stats:
+		print("%d clocks, %.2f bpm" % (stats['clocks'], stats['tempo']))
+		print("interval mean=%.1fus min=%.1fus p99=%.1fus max=%.1fus stddev=%.1fus" % (
+			stats['mean'] * 1e6, stats['min'] * 1e6, stats['p99'] * 1e6,
+			stats['max'] * 1e6, stats['jitter'] * 1e6))
+
+def _replay(args):
+	from clicktrack.dispatcher import ClickRouter, ReplayDispatcher
+
+	router = ClickRouter(ReplayDispatcher)
+	router.set_replay(ClockCapture.load(args.file), fast=args.fast)
+	router.start()
+	try:
+		router.dispatcher.join()
+	except KeyboardInterrupt:
+		pass
+	router.stop()
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Record and replay MIDI clock captures.')
+	commands = parser.add_subparsers(dest='command')
+
+	record = commands.add_parser('record', help='capture clock from a MIDI input')
+	record.add_argument('port', help='part of the input port name')
+	record.add_argument('file')
+	record.add_argument('-d', '--duration', type=float, default=60.0)
+
+	info = commands.add_parser('info', help='show capture statistics')
+	info.add_argument('file')
+
+	replay = commands.add_parser('replay', help='replay a capture to all MIDI outputs')
+	replay.add_argument('file')
+	replay.add_argument('--fast', action='store_true',
+		help='replay as fast as possible instead of in real time')
+
+	args = parser.parse_args(argv)
+	handlers = {'record': _record, 'info': _info, 'replay': _replay}
+	if args.command not in handlers:
+		parser.print_help()
+		return 1
+
+	try:
+		handlers[args.command](args)
+	except CaptureError as e:
+		sys.stderr.write(e.message + "\n")
+		return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,396 @@
+import math
+import os
+import socket
+import selectors
+import struct
+import sys
+import threading
+import time
+
+import clicktrack.master as ctmaster
+from clicktrack.isolated import IsolatedClickRouter
+
+"""
+Remote control for master mode.
+
+ControlServer listens for commands on a UDP port (OSC) and on a UNIX datagram
+socket (OSC or plain text, e.g. "tempo 128"), so that a playback laptop or a
+foot controller can drive the click without touching the screen. Each command
+is answered with an acknowledgement carrying the current state.
+
+Commands:
+
+	OSC address       text         effect
+	/transport/start  start        start the clock
+	/transport/stop   stop         stop the clock
+	/transport/toggle toggle       start or stop the clock
+	/song/next        next         select the next song
+	/song/prev        prev         select the previous song
+	/song/select i    song N       select song N (counting from 1)
+	/tempo f          tempo BPM    set the tempo of the current song
+	/tempo/nudge f    nudge DELTA  change the tempo by DELTA
+	/tap              tap          tap tempo
+	/state            state        only reply with the state
+
+OSC replies are sent to the sender as /ack (address, running, song, songs,
+tempo, multiplier) or /error (address, message). Text replies are a single
+line, "ok ..." or "error ...".
+
+Tempo changes are applied by the dispatcher at the next tick boundary (see
+ClickRouter.retime()), never in the middle of an interval.
+"""
+
+DEFAULT_UDP_PORT = 9123
+DEFAULT_SOCKET_PATH = '/tmp/piclicktrack.sock'
+
+# taps further apart than this start a new measurement
+TAP_TIMEOUT = 2.0
+
+"""
+Thread-safe front-end to a ClickMaster and the router it drives. The listener,
+if given, is called (from the control thread) after every change so that the
+GUI can refresh itself.
+"""
+class MasterController:
+	master = None
+	router = None
+	listener = None
+
+	def __init__(self, master, router, listener=None):
+		self.master = master
+		self.router = router
+		self.listener = listener
+		self.lock = threading.Lock()
+		self.detector = ctmaster.TempoDetector()
+		self.detector.beats = []
+
+	def _changed(self):
+		if self.listener:
+			self.listener()
+
+	def _apply_song(self):
+		self.router.change_song(float(self.master.get_tempo()),
+			self.master.get_multiplier(), self.master.get_pattern())
+		if isinstance(self.router, IsolatedClickRouter):
+			self.router.set_song(self.master.get_song())
+
+	def start(self):
+		with self.lock:
+			if not self.router.started:
+				self.router.start()
+		self._changed()
+
+	def stop(self):
+		with self.lock:
+			if self.router.started:
+				self.router.stop()
+		self._changed()
+
+	def toggle(self):
+		with self.lock:
+			if self.router.started:
+				self.router.stop()
+			else:
+				self.router.start()
+		self._changed()
+
+	def select_song(self, index):
+		with self.lock:
+			self.master.select_song(index)
+			self._apply_song()
+		self._changed()
+
+	def next_song(self):
+		self.select_song(self.master.get_song() + 1)
+
+	def prev_song(self):
+		self.select_song(self.master.get_song() - 1)
+
+	def add_song(self):
+		with self.lock:
+			self.master.add_song()
+			self.master.last_song()
+			self._apply_song()
+		self._changed()
+
+	"""
+	Change the clicks per beat of the current song. Takes effect right away.
+	"""
+	def set_multiplier(self, multiplier):
+		with self.lock:
+			self.master.set_multiplier(multiplier)
+			self.router.set_tempo(float(self.master.get_tempo()), multiplier)
+			self.router.set_pattern(self.master.get_pattern())
+		self._changed()
+
+	def set_tempo(self, tempo):
+		with self.lock:
+			self.master.change_tempo(tempo - self.master.get_tempo())
+			self.router.retime(float(self.master.get_tempo()))
+		self._changed()
+
+	def nudge_tempo(self, change):
+		self.set_tempo(self.master.get_tempo() + change)
+
+	def tap(self):
+		now = time.monotonic()
+		with self.lock:
+			beats = self.detector.beats
+			if beats and now - beats[-1][0] > TAP_TIMEOUT:
+				del beats[:]
+			self.detector.beat(1, now)
+			if len(beats) < 2:
+				return
+			tempo = round(self.detector.get_tempo())
+
+		self.set_tempo(tempo)
+
+	def state(self):
+		return {
+			'running': self.router.started,
+			'song': self.master.get_song() + 1,
+			'songs': self.master.count_songs() + 1,
+			'tempo': float(self.master.get_tempo()),
+			'multiplier': self.master.get_multiplier(),
+		}
+
+"""
+Control socket server thread.
+"""
+class ControlServer(threading.Thread):
+	controller = None
+	quit = False
+
+	def __init__(self, controller, udp_port=DEFAULT_UDP_PORT, udp_host='0.0.0.0',
+			socket_path=DEFAULT_SOCKET_PATH):
+		super(self.__class__, self).__init__(name='control')
+		self.daemon = True
+		self.controller = controller
+		self.udp_port = udp_port
+		self.udp_host = udp_host
+		self.socket_path = socket_path
+		self.sockets = []
+		self.selector = selectors.DefaultSelector()
+
+		self.commands = {
+			'/transport/start': (controller.start, None),
+			'/transport/stop': (controller.stop, None),
+			'/transport/toggle': (controller.toggle, None),
+			'/song/next': (controller.next_song, None),
+			'/song/prev': (controller.prev_song, None),
+			'/song/select': (lambda n: controller.select_song(n - 1), int),
+			'/tempo': (controller.set_tempo, float),
+			'/tempo/nudge': (controller.nudge_tempo, float),
+			'/tap': (controller.tap, None),
+			'/state': (lambda: None, None),
+		}
+		self.text_commands = {
+			'start': '/transport/start',
+			'stop': '/transport/stop',
+			'toggle': '/transport/toggle',
+			'next': '/song/next',
+			'prev': '/song/prev',
+			'song': '/song/select',
+			'tempo': '/tempo',
+			'nudge': '/tempo/nudge',
+			'tap': '/tap',
+			'state': '/state',
+		}
+
+	def start(self):
+		if self.udp_port:
+			udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			udp.bind((self.udp_host, self.udp_port))
+			self._register(udp)
+
+		if self.socket_path:
+			if os.path.exists(self.socket_path):
+				os.unlink(self.socket_path)
+			unix = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+			unix.bind(self.socket_path)
+			self._register(unix)
+
+		# a socketpair so that stop() can wake the selector
+		(self.wakeup_r, self.wakeup_w) = socket.socketpair()
+		self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+
+		self.quit = False
+		super(self.__class__, self).start()
+
+	def _register(self, sock):
+		sock.setblocking(False)
+		self.sockets.append(sock)
+		self.selector.register(sock, selectors.EVENT_READ)
+
+	def run(self):
+		while not self.quit:
+			for (key, events) in self.selector.select():
+				if key.fileobj is self.wakeup_r:
+					continue
+				try:
+					(packet, sender) = key.fileobj.recvfrom(4096)
+				except (BlockingIOError, InterruptedError):
+					continue
+				try:
+					reply = self.handle_packet(packet)
+				except Exception as e:
+					# one bad datagram must not take the server down
+					sys.stderr.write("Control packet failed: %r\n" % (e))
+					continue
+				if reply and sender:
+					try:
+						key.fileobj.sendto(reply, sender)
+					except OSError:
+						pass
+
+	def stop(self):
+		self.quit = True
+		self.wakeup_w.send(b'\0')
+		self.join()
+
+		for sock in self.sockets:
+			self.selector.unregister(sock)
+			sock.close()
+		self.sockets = []
+		self.selector.close()
+		self.wakeup_r.close()
+		self.wakeup_w.close()
+
+		if self.socket_path and os.path.exists(self.socket_path):
+			os.unlink(self.socket_path)
+
+	"""
+	Handle one packet and return the reply to send back, if any.
+	"""
+	def handle_packet(self, packet):
+		if b'\0' not in packet:
+			return self.handle_text(packet.decode('utf-8', 'replace'))
+
+		try:
+			messages = osc_decode(packet)
+		except (ValueError, struct.error, IndexError):
+			return osc_encode('/error', ['', 'malformed OSC packet'])
+
+		reply = b''
+		for (address, args) in messages:
+			error = self.execute(address, args)
+			if error:
+				reply = osc_encode('/error', [address, error])
+			else:
+				state = self.controller.state()
+				reply = osc_encode('/ack', [address, int(state['running']),
+					state['song'], state['songs'], state['tempo'],
+					state['multiplier']])
+		return reply
+
+	def handle_text(self, text):
+		words = text.split()
+		if not words:
+			return None
+
+		if words[0] not in self.text_commands:
+			return ("error unknown command %s\n" % (words[0])).encode('utf-8')
+
+		error = self.execute(self.text_commands[words[0]], words[1:])
+		if error:
+			return ("error %s\n" % (error)).encode('utf-8')
+
+		state = self.controller.state()
+		return ("ok running=%d song=%d/%d tempo=%g multiplier=%d\n" % (
+			state['running'], state['song'], state['songs'], state['tempo'],
+			state['multiplier'])).encode('utf-8')
+
+	"""
+	Run a command. Returns an error message, or None on success.
+	"""
+	def execute(self, address, args):
+		if address not in self.commands:
+			return 'unknown command'
+
+		(fn, argtype) = self.commands[address]
+		try:
+			if argtype:
+				if not args:
+					return 'missing argument'
+				value = float(args[0])
+				if not math.isfinite(value):
+					return 'invalid argument'
+				fn(argtype(value))
+			else:
+				fn()
+		except (ValueError, TypeError, OverflowError):
+			return 'invalid argument'
+		except ctmaster.ClickMasterError as e:
+			return e.message
+
+		return None
+
+"""
+Minimal OSC 1.0 codec. Supports the i, f, d, s, T and F argument types, and
+bundles (whose time tags are ignored; everything is executed on receipt).
+"""
+def _osc_string(data, offset):
+	end = data.index(b'\0', offset)
+	value = data[offset:end].decode('utf-8', 'replace')
+	return (value, (end + 4) & ~3)
+
+def osc_decode(data):
+	if data.startswith(b'#bundle\0'):
+		messages = []
+		offset = 16
+		while offset < len(data):
+			(size,) = struct.unpack('>i', data[offset:offset+4])
+			messages.extend(osc_decode(data[offset+4:offset+4+size]))
+			offset += 4 + size
+		return messages
+
+	(address, offset) = _osc_string(data, 0)
+	if not address.startswith('/'):
+		raise ValueError('not an OSC message')
+
+	args = []
+	if offset < len(data):
+		(tags, offset) = _osc_string(data, offset)
+		for tag in tags[1:]:
+			if tag == 'i':
+				args.append(struct.unpack('>i', data[offset:offset+4])[0])
+				offset += 4
+			elif tag == 'f':
+				args.append(struct.unpack('>f', data[offset:offset+4])[0])
+				offset += 4
+			elif tag == 'd':
+				args.append(struct.unpack('>d', data[offset:offset+8])[0])
+				offset += 8
+			elif tag == 's':
+				(value, offset) = _osc_string(data, offset)
+				args.append(value)
+			elif tag == 'T':
+				args.append(True)
+			elif tag == 'F':
+				args.append(False)
+			else:
+				raise ValueError('unsupported OSC type %s' % (tag))
+
+	return [(address, args)]
+
+def _osc_pad(data):
+	return data + b'\0' * (4 - len(data) % 4)
+
+def osc_encode(address, args):
+	tags = ','
+	payload = b''
+	for arg in args:
+		if isinstance(arg, bool):
+			tags += 'T' if arg else 'F'
+		elif isinstance(arg, int):
+			tags += 'i'
+			payload += struct.pack('>i', arg)
+		elif isinstance(arg, float):
+			tags += 'f'
+			payload += struct.pack('>f', arg)
+		else:
+			tags += 's'
+			payload += _osc_pad(str(arg).encode('utf-8'))
+
+	return _osc_pad(address.encode('utf-8')) + _osc_pad(tags.encode('utf-8')) + payload
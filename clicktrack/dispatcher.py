@@ -1,24 +1,72 @@
 import threading
 import rtmidi
 import time
-import wave
-import alsaaudio
-import os
 import re
-from queue import Queue
+import sys
+import functools
+import heapq
+import bisect
+from collections import deque
+
+from clicktrack import audio
+from clicktrack import voices
+from clicktrack import routing
+from clicktrack.trace import (SPAN_SLEEP, SPAN_PUT, SPAN_SEND, SPAN_WRITE,
+	SPAN_CALLBACK, EVENT_WAKE)
 
 MSG_CLOCK_START = 0xFA
 MSG_CLOCK_BEAT  = 0xF8
 MSG_CLOCK_CONTINUE = 0xFB
 MSG_CLOCK_STOP  = 0xFC
 
+# Transport messages published by the router (or received in thru mode), and
+# the realtime message each output sends for them
+TRANSPORT_MESSAGES = {
+	'start': MSG_CLOCK_START,
+	'continue': MSG_CLOCK_CONTINUE,
+	'pause': MSG_CLOCK_STOP,
+	'stop': MSG_CLOCK_STOP,
+}
+
+# Number of routed (non-clock) messages that may queue up per output
+ROUTE_BACKLOG = 1024
+
+# Ticks kept queued ahead in the sequencer by SequencerOutput
+SEQUENCER_WINDOW = 12
+
+# Time from the last worker getting ready to the transport start, which every
+# output fires at together
+START_LEAD = 0.005
+
+# How long the workers may take to get their devices ready for a start
+READY_TIMEOUT = 2.0
+
+# MIDI clock ticks per beat
+PPQN = 24
+
+# Number of published messages a worker can fall behind by before it loses
+# them (over 10 seconds at 300bpm)
+SEQUENCE_SIZE = 4096
+
+# Clock source states reported by FailoverDispatcher
+CLOCK_WAITING  = 'waiting'
+CLOCK_SOURCE   = 'source'
+CLOCK_FLYWHEEL = 'flywheel'
+CLOCK_STOPPED  = 'stopped'
+
+# Worker queue overflow policies, see ClickQueue
+POLICY_KEEP_ALL    = 'keep-all'
+POLICY_DROP_OLDEST = 'drop-oldest'
+POLICY_COALESCE    = 'coalesce'
+
 """
 Front-end to the click dispatcher.
 
 The click dispatcher uses a thread pool consisting of one thread per MIDI output
 and one master thread. The master thread runs an HrTimer (see below) that
 dispatches click events to the port threads as close to synchronously as
-possible (the lag time is the time it takes for Queue.put()).
+possible. Events are published once to a TickSequence that all workers read,
+so the lag time does not grow with the number of ports.
 """
 
 class ClickRouter:
@@ -28,12 +76,53 @@ class ClickRouter:
 	started = False
 	debounce_ports = []
 	multiplier = 1
+	pattern = None
 	
 	tempo = 120.0
 	input_port = None
+	capture = None
+	replay = None
+	replay_fast = False
+	input_ports = []
+	clock_input = 0
+	routes = []
+	failover_ticks = 3
+	state_listener = None
+	tracer = None
+	trace = None
+	sequencer = None
+	scheduler = None
+	port_filter = None
+	sound = True
+	
+	# Queue policy and bound for each kind of worker. MIDI outputs drop the
+	# oldest clock after a beat's worth has piled up, so that a stuck device
+	# does not replay a stale burst once it recovers. The audible click and
+	# the GUI callback only care about the latest state.
+	output_policy = (POLICY_DROP_OLDEST, 24)
+	sound_policy = (POLICY_COALESCE, 0)
+	callback_policy = (POLICY_COALESCE, 0)
+	
+	drops = {}
+	deferred = None
+	ticks = 0
+	# the tick the current song's bars are counted from
+	bar_origin = 0
+	sequence = None
+	
+	# transport state of the current run, see start() and stop()
+	barrier = None
+	start_time = None
+	announced = False
+	stopping = None
+	stop_time = None
+	next_song = None
 	
 	def __init__(self, backend=None):
 		self.backend = backend if backend else TimedDispatcher
+		self.threads = []
+		self.drops = {}
+		self.deferred = deque()
 	
 	"""
 	Initialization function called before start() kicks off the threads. This
@@ -41,88 +130,334 @@ class ClickRouter:
 	restarting threads that were previously stopped.
 	"""
 	def init(self, callback=None):
-		midi_out = rtmidi.MidiOut()
-		for i in range(0, midi_out.get_port_count()):
-			name = midi_out.get_port_name(i)
-			# this is necessary to avoid reflection back into our own port which
-			# causes horrible bouncing issues
-			if re.search('^RtMidiIn Client:', name):
-				continue
-			
-			print("Opening MIDI output port: %s" % (name))
-			self._open_port(i)
+		# the sequencer can only schedule ticks ahead if we know when they are
+		# due
+		if self.sequencer and self.is_timed():
+			self.threads.append(SequencerOutput(self.sequencer, self))
+		else:
+			self._open_outputs()
 		
 		# add a thread for playing the audible click
-		self.threads.append(ClickSound(self.multiplier))
+		if self.sound:
+			self._open_sound()
 		
 		if callback:
-			self.threads.append(ClickCallback(callback))
+			self.threads.append(ClickCallback(callback, self.callback_policy))
+		
+		self.sequence = TickSequence()
+		for t in self.threads:
+			t.queue.attach(self.sequence)
+		
+		# the workers and start() meet here once every device is ready; the
+		# last one to arrive sets the start deadline
+		self.start_time = None
+		self.barrier = threading.Barrier(len(self.threads) + 1,
+			action=self._schedule_start)
+		for t in self.threads:
+			t.barrier = self.barrier
 		
 		self.dispatcher = self.backend(self.click)
 		
-		if isinstance(self.dispatcher, TimedDispatcher):
+		if isinstance(self.dispatcher, DomainDispatcher):
+			self.dispatcher.set_scheduler(self.scheduler)
+		if self.is_timed():
 			self.dispatcher.set_tempo(self.tempo)
 		
-		if isinstance(self.dispatcher, MIDIInputDispatcher):
+		if isinstance(self.dispatcher, ReplayDispatcher):
+			self.dispatcher.set_replay(self.replay, self.replay_fast)
+		elif isinstance(self.dispatcher, MultiInputDispatcher):
+			self.dispatcher.set_input_ports(self.input_ports, self.clock_input)
+			self.dispatcher.set_capture(self.capture)
+			self.dispatcher.set_routes(self.routes, self._route_outputs())
+			if isinstance(self.dispatcher, FailoverDispatcher):
+				self.dispatcher.set_failover(self.failover_ticks, self.state_listener)
+		elif isinstance(self.dispatcher, MIDIInputDispatcher):
 			self.dispatcher.set_input_port(self.input_port)
+			self.dispatcher.set_capture(self.capture)
+		
+		if self.tracer:
+			for t in self.threads:
+				t.trace = self.tracer.buffer(t.name)
+			# click() runs on the dispatcher's thread
+			self.trace = self.tracer.buffer('dispatcher')
+			if isinstance(self.dispatcher, TimedDispatcher):
+				self.dispatcher.timer.trace = self.trace
+			self.tracer.start()
+	
+	"""
+	Whether the clock is generated here rather than received from MIDI input.
+	"""
+	def is_timed(self):
+		return issubclass(self.backend, (TimedDispatcher, DomainDispatcher))
+	
+	"""
+	Output index => worker, for compiling routes.
+	"""
+	def _route_outputs(self):
+		outputs = {}
+		for t in self.threads:
+			if isinstance(t, ClickOutput):
+				outputs[t.index] = t
+		return outputs
+	
+	def _open_outputs(self):
+		midi_out = rtmidi.MidiOut()
+		for i in range(0, midi_out.get_port_count()):
+			name = midi_out.get_port_name(i)
+			# this is necessary to avoid reflection back into our own port which
+			# causes horrible bouncing issues
+			if re.search('^RtMidiIn Client:', name):
+				continue
+			
+			if self.port_filter and not re.search(self.port_filter, name):
+				continue
+			
+			print("Opening MIDI output port: %s" % (name))
+			self._open_port(i)
 	
 	def _open_port(self, i):
 		midi_out = rtmidi.MidiOut()
 		midi_out.open_port(i)
 		
-		self.threads.append(ClickOutput(midi_out, i, self))
+		self._add_output(midi_out, i)
+	
+	def _add_output(self, midi_out, index):
+		self.threads.append(ClickOutput(midi_out, index, self))
+	
+	def _open_sound(self):
+		self.threads.append(ClickSound(self.multiplier, self.sound_policy, self.pattern))
 		
 	"""
 	Dispatches a click event to the MIDI output ports.
 	"""
 	def click(self, msg='click'):
-		for port in self.threads:
-			port.queue.put(msg)
+		while self.deferred:
+			self.deferred.popleft()()
+		
+		if msg == 'click':
+			if self.stopping:
+				self._stop_transport()
+				return
+			song = self.next_song
+			new_bar = song and (self.ticks - self.bar_origin) % (PPQN * self._beats()) == 0
+			if new_bar:
+				self._change_song(song)
+			if not self.announced:
+				# the transport starts with the first tick, on every output
+				# at once
+				self.announced = True
+				self.sequence.publish('start')
+			self.ticks += 1
+			if new_bar:
+				# The new song's bars start on this tick. Moved only after the
+				# count, so get_bar_phase() never sees a tick before the bar.
+				self.bar_origin = self.ticks - 1
+				self.sequence.publish('bar')
+		elif msg == 'start':
+			self.ticks = 0
+			self.bar_origin = 0
+			self.announced = True
+		
+		trace = self.trace
+		if trace:
+			start = time.monotonic()
+			self.sequence.publish(msg)
+			trace.span(SPAN_PUT, start, time.monotonic(), len(self.threads))
+		else:
+			self.sequence.publish(msg)
+	
+	"""
+	Returns (number of ticks since the start, time of the last tick, tick
+	interval), or None if the clock isn't running. Used by the GUI to predict
+	upcoming beats.
+	"""
+	def get_phase(self):
+		dispatcher = self.dispatcher
+		if not dispatcher or not self.ticks:
+			return None
+		
+		phase = dispatcher.get_phase()
+		if not phase:
+			return None
+		return (self.ticks, phase[0], phase[1])
+	
+	"""
+	Same as get_phase(), but counting the ticks from the first tick of the
+	current song's bars rather than from the start, so that the first of them
+	is a downbeat. The two differ once a song change has been applied.
+	"""
+	def get_bar_phase(self):
+		phase = self.get_phase()
+		if not phase:
+			return None
+		return (phase[0] - self.bar_origin, phase[1], phase[2])
+	
+	"""
+	Run a function on the dispatcher thread at the next tick boundary, or
+	right away if the clock isn't running. Keep it cheap: it delays the tick.
+	"""
+	def defer(self, fn):
+		if self.started:
+			self.deferred.append(fn)
+		else:
+			fn()
+	
+	"""
+	Change only the tick interval, effective from the next tick. Unlike
+	set_tempo() this does not touch the workers, so it is safe to call at
+	any time without disturbing the timer. While a song change is pending,
+	the new tempo goes to that song instead.
+	"""
+	def retime(self, tempo):
+		song = self.next_song
+		if song:
+			# The tempo is meant for the song we are switching to; the one
+			# still playing finishes its bar at its own tempo.
+			self.next_song = (tempo,) + song[1:]
+			return
+		
+		self.tempo = tempo
+		self.defer(self._apply_tempo)
+	
+	def _apply_tempo(self):
+		if self.dispatcher and self.is_timed():
+			self.dispatcher.set_tempo(self.tempo)
+	
+	"""
+	Switch to another song's tempo, subdivision and click pattern. While the
+	clock is running the switch waits for the next bar, so the song being
+	played finishes its bar as it was. A set_tempo() in the meantime takes
+	precedence over the pending switch.
+	"""
+	def change_song(self, tempo, multiplier=1, pattern=None):
+		if not self.started:
+			self.set_tempo(tempo, multiplier)
+			if pattern:
+				self.set_pattern(pattern)
+			return
+		
+		self.next_song = (tempo, multiplier, pattern)
+	
+	"""
+	Apply a pending song switch. Runs on the dispatcher thread, just before
+	the first tick of a bar.
+	"""
+	def _change_song(self, song):
+		(tempo, multiplier, pattern) = song
+		self.set_tempo(tempo, multiplier)
+		if pattern:
+			self.set_pattern(pattern)
+	
+	def _beats(self):
+		return self.pattern.beats if self.pattern else 4
 	
 	"""
 	Start the selected dispatcher.
+	
+	The transport starts at a common deadline rather than whenever each
+	output's thread comes up: every worker first gets its device ready, then
+	the first tick is scheduled a few milliseconds ahead, and on that tick
+	every output receives the start message and the first clock together.
 	"""
 	def start(self, callback=None):
 		self.init(callback)
-		# First start all of the output threads so that they're ready to accept
-		# events as soon as the dispatcher starts up.
-		#
-		# This also sends MSG_CLOCK_START to all slaves.
+		self.announced = False
+		self.stopping = None
+		self.next_song = None
+		self.bar_origin = 0
 		for t in self.threads:
 			t.start()
 		
-		# Start the dispatcher, which will instantly begin dispatching click
-		# events.
-		self.dispatcher.start()
+		wait_ready(self.barrier)
+		if self.start_time is None:
+			sys.stderr.write("Not every output got ready in time, starting anyway\n")
+			self._schedule_start()
+		
+		self.ticks = 0
+		if self.is_timed():
+			self.dispatcher.start(self.start_time)
+		else:
+			self.dispatcher.start()
 		
 		self.started = True
 	
+	def _schedule_start(self):
+		self.start_time = time.monotonic() + START_LEAD
+	
 	"""
 	Stop the selected dispatcher and cleanly terminate all threads.
+	
+	With a timed dispatcher the transport stops in place of the next tick, so
+	that every output sends the stop message at the same time. Workers are
+	told when that will be with a 'stopping' message, for the ones that
+	queue ticks ahead of time (SequencerOutput).
 	"""
 	def stop(self):
+		stopping = None
+		if self.is_timed():
+			stopping = threading.Event()
+			self.stopping = stopping
+			# set first, so that a tick running meanwhile either is the stop
+			# or is already counted in the phase
+			(last, interval) = self.dispatcher.get_phase()
+			self.stop_time = last + interval
+			self.sequence.publish('stopping')
+			stopping.wait(interval * 2)
+		
 		self.dispatcher.stop()
 		
+		# the dispatcher is gone, so this can't race with _stop_transport()
+		if not stopping or not stopping.is_set():
+			self.sequence.publish('stop')
 		for t in self.threads:
 			t.stop()
 		
+		# keep the drop counters around for the whole session
+		self.drops = self.get_drops()
 		self.threads = []
 		self.dispatcher = None
+		self.trace = None
+		self.stopping = None
 		
 		self.started = False
 	
+	def _stop_transport(self):
+		if not self.stopping.is_set():
+			self.sequence.publish('stop')
+			self.stopping.set()
+	
 	"""
 	Change the tempo. Only valid for the timed dispatcher.
 	"""
 	def set_tempo(self, tempo, multiplier=1):
 		self.tempo = tempo
 		self.multiplier = multiplier
+		self.next_song = None
 		if self.dispatcher:
 			self.dispatcher.set_tempo(tempo)
 		
 		for t in self.threads:
 			t.set_multiplier(multiplier)
 	
+	"""
+	Change the click pattern (see voices.ClickPattern) of the audible click.
+	"""
+	def set_pattern(self, pattern):
+		self.pattern = pattern
+		
+		for t in self.threads:
+			t.set_pattern(pattern)
+	
+	"""
+	Return the number of clicks dropped so far, keyed by worker name.
+	"""
+	def get_drops(self):
+		drops = dict(self.drops)
+		for t in self.threads:
+			drops[t.name] = drops.get(t.name, 0) + t.queue.dropped
+		
+		return drops
+	
 	"""
 	Set the input port. Only valid for the MIDI input dispatcher.
 	"""
@@ -130,6 +465,83 @@ class ClickRouter:
 		self.input_port = port
 		if self.dispatcher:
 			self.dispatcher.set_input_port(port)
+	
+	"""
+	Set the input ports and the index of the one that provides the clock.
+	Only valid for the multi-input dispatcher.
+	"""
+	def set_input_ports(self, ports, clock_input=0):
+		self.input_ports = ports
+		self.clock_input = clock_input
+	
+	"""
+	Set the routes (see routing.Route) for non-clock messages. Only valid for
+	the multi-input dispatcher; takes effect on the next start().
+	"""
+	def set_routes(self, routes):
+		self.routes = routes
+	
+	"""
+	Configure the failover dispatcher: after how many missing clock ticks the
+	internal clock takes over, and a function to call with the new state
+	(one of the CLOCK_* constants) whenever it changes.
+	"""
+	def set_failover(self, ticks, listener=None):
+		self.failover_ticks = ticks
+		self.state_listener = listener
+	
+	"""
+	Record incoming clock into a capture.ClockCapture. Only valid for the MIDI
+	input dispatcher.
+	"""
+	def set_capture(self, capture):
+		self.capture = capture
+		if self.dispatcher:
+			self.dispatcher.set_capture(capture)
+	
+	"""
+	Only open the MIDI outputs whose name matches this regular expression
+	(None for all of them), so that several routers can drive different
+	groups of ports. Takes effect on the next start().
+	"""
+	def set_port_filter(self, pattern):
+		self.port_filter = pattern
+	
+	"""
+	Whether this router plays the audible click. Only one router at a time can
+	have the audio device. Takes effect on the next start().
+	"""
+	def set_sound(self, enabled):
+		self.sound = enabled
+	
+	"""
+	Share the given DomainScheduler with other routers. Only valid for the
+	domain dispatcher; takes effect on the next start().
+	"""
+	def set_scheduler(self, scheduler):
+		self.scheduler = scheduler
+	
+	"""
+	Send the clock through a sequencer.SequencerBackend instead of the MIDI
+	output ports. Only used with the timed dispatcher; takes effect on the
+	next start().
+	"""
+	def set_sequencer(self, backend):
+		self.sequencer = backend
+	
+	"""
+	Record trace events (see trace.Tracer) from the timer and every worker.
+	Takes effect on the next start().
+	"""
+	def set_tracer(self, tracer):
+		self.tracer = tracer
+	
+	"""
+	Set the capture to play back. Only valid for the replay dispatcher.
+	"""
+	def set_replay(self, capture, fast=False):
+		self.replay = capture
+		self.replay_fast = fast
 
 """
 Timed clock event dispatcher. This is the "master" thread, which dispatches the
@@ -139,6 +551,7 @@ class TimedDispatcher(threading.Thread):
 	timer = None
 	tempo = 120.0
 	callback = None
+	first = None
 	
 	def __init__(self, callback):
 		super(self.__class__, self).__init__()
@@ -151,16 +564,186 @@ class TimedDispatcher(threading.Thread):
 		self.tempo = tempo
 		self.timer.interval = 60.0 / self.tempo / 24.0
 	
-	def start(self):
+	"""
+	Start the timer. The first tick is sent at the given time.monotonic()
+	time, or right away.
+	"""
+	def start(self, first=None):
+		self.first = first
 		self.timer.should_stop = False
 		super(self.__class__, self).start()
 	
 	def run(self):
-		self.timer.run()
+		self.timer.run(self.first)
 	
 	def stop(self):
 		self.timer.should_stop = True
 		self.join()
+	
+	"""
+	Returns (time of the last tick, tick interval).
+	"""
+	def get_phase(self):
+		return (self.timer.deadline, self.timer.interval)
+
+"""
+Clock domain dispatcher. Like TimedDispatcher, but instead of running a timer
+thread of its own it registers with a DomainScheduler, which keeps the tick
+grids of any number of routers (each with its own tempo, transport and group
+of ports, see ClickRouter.set_port_filter()) on a single thread.
+"""
+class DomainDispatcher:
+	callback = None
+	scheduler = None
+	tempo = 120.0
+	interval = 60.0 / 120.0 / 24.0
+	deadline = 0.0
+	
+	def __init__(self, callback):
+		self.callback = callback
+		# bumped whenever the entry in the scheduler's heap goes stale
+		self.version = 0
+		self.active = False
+	
+	def set_scheduler(self, scheduler):
+		self.scheduler = scheduler
+	
+	def set_tempo(self, tempo):
+		self.tempo = tempo
+		self.interval = 60.0 / tempo / 24.0
+		if self.active:
+			self.scheduler.reschedule(self)
+	
+	"""
+	Register with the scheduler. The first tick is sent at the given
+	time.monotonic() time, or right away.
+	"""
+	def start(self, first=None):
+		if not self.scheduler:
+			self.scheduler = DomainScheduler.shared()
+		self.scheduler.add(self, first)
+	
+	"""
+	Unregister from the scheduler. Returns once the tick being sent, if any,
+	is out.
+	"""
+	def stop(self):
+		self.scheduler.remove(self)
+	
+	"""
+	Returns (time of the last tick, tick interval).
+	"""
+	def get_phase(self):
+		return (self.deadline, self.interval)
+
+"""
+Single timing thread for many clock domains.
+
+Keeps a heap of (deadline, ...) entries, one per running DomainDispatcher, and
+sleeps until the earliest deadline with the same backoff as HrTimer. Adding,
+removing or retiming a domain wakes it up to look at the heap again. Ticks are
+sent with the scheduler lock released, so a slow router only delays the
+domains due after it; like HrTimer, missed deadlines are caught up on
+immediately and each domain stays on its own grid. A domain whose tick raises
+is dropped from the heap, and the others keep going.
+"""
+class DomainScheduler(threading.Thread):
+	default = None
+	
+	def __init__(self):
+		super(DomainScheduler, self).__init__(name='domain scheduler')
+		self.daemon = True
+		self.heap = []
+		self.counter = 0
+		self.firing = None
+		self.changed = threading.Condition()
+	
+	"""
+	The scheduler used by domain dispatchers that weren't given one.
+	"""
+	@classmethod
+	def shared(cls):
+		if cls.default is None:
+			cls.default = cls()
+		return cls.default
+	
+	def _push(self, dispatcher, deadline):
+		self.counter += 1
+		heapq.heappush(self.heap, (deadline, self.counter, dispatcher.version, dispatcher))
+		self.changed.notify_all()
+	
+	def add(self, dispatcher, first=None):
+		with self.changed:
+			if not self.is_alive():
+				self.start()
+			dispatcher.version += 1
+			dispatcher.active = True
+			self._push(dispatcher, first if first is not None else time.monotonic())
+	
+	def remove(self, dispatcher):
+		with self.changed:
+			dispatcher.active = False
+			dispatcher.version += 1
+			while self.firing is dispatcher:
+				self.changed.wait()
+	
+	"""
+	Move a domain's next deadline after its interval changed.
+	"""
+	def reschedule(self, dispatcher):
+		with self.changed:
+			if not dispatcher.active or self.firing is dispatcher:
+				# the next deadline is worked out after the tick anyway
+				return
+			dispatcher.version += 1
+			self._push(dispatcher, dispatcher.deadline + dispatcher.interval)
+	
+	def run(self):
+		while True:
+			with self.changed:
+				dispatcher = self._wait_due()
+				self.firing = dispatcher
+			
+			failed = False
+			try:
+				dispatcher.callback()
+			except Exception as e:
+				sys.stderr.write("Clock domain failed, dropping it: %r\n" % (e))
+				failed = True
+			
+			with self.changed:
+				self.firing = None
+				if failed:
+					dispatcher.active = False
+					dispatcher.version += 1
+				if dispatcher.active:
+					self._push(dispatcher, dispatcher.deadline + dispatcher.interval)
+				else:
+					self.changed.notify_all()
+	
+	"""
+	Wait for the earliest deadline, and return its dispatcher with its
+	deadline set. Called with the lock held.
+	"""
+	def _wait_due(self):
+		while True:
+			if not self.heap:
+				self.changed.wait()
+				continue
+			
+			(deadline, n, version, dispatcher) = self.heap[0]
+			if version != dispatcher.version:
+				heapq.heappop(self.heap)
+				continue
+			
+			rem = deadline - time.monotonic()
+			if rem > 0:
+				self.changed.wait(rem * 0.925)
+				continue
+			
+			heapq.heappop(self.heap)
+			dispatcher.deadline = deadline
+			return dispatcher
 
 """
 MIDI clock event based dispatcher
@@ -169,14 +752,21 @@ class MIDIInputDispatcher(threading.Thread):
 	callback = None
 	quit = False
 	input_port = None
+	capture = None
+	
+	# smoothing factor for the incoming clock period estimate
+	SMOOTHING = 0.1
 	
 	def __init__(self, callback):
-		super(self.__class__, self).__init__()
+		super(MIDIInputDispatcher, self).__init__()
 		self.callback = callback
+		self.last = None
+		self.period = None
+		self.clocks = 0
 	
 	def start(self):
 		self.quit = False
-		super(self.__class__, self).start()
+		super(MIDIInputDispatcher, self).start()
 	
 	def run(self):
 		self.input_port.ignore_types(timing=False)
@@ -188,7 +778,13 @@ class MIDIInputDispatcher(threading.Thread):
 	
 	def recv_message(self, result, data=None):
 			message, delta_time = result
+			if message[0] >= MSG_CLOCK_BEAT:
+				now = time.monotonic()
+				if self.capture:
+					self.capture.record(message[0], delta_time, now)
+			
 			if message[0] == MSG_CLOCK_BEAT:
+				self._track(now)
 				self.callback()
 			elif message[0] == MSG_CLOCK_START:
 				self.callback('start')
@@ -200,9 +796,249 @@ class MIDIInputDispatcher(threading.Thread):
 	def stop(self):
 		self.quit = True
 		self.join()
+	
+	"""
+	Track the time of the last clock and the average clock period, ignoring
+	gaps in the clock.
+	"""
+	def _track(self, now):
+		if self.last is not None:
+			delta = now - self.last
+			if self.period is None:
+				self.period = delta
+			elif delta < self.period * 2:
+				self.period += (delta - self.period) * self.SMOOTHING
+		
+		self.last = now
+		self.clocks += 1
+	
+	"""
+	Returns (time of the last clock, estimated clock period), or None until
+	enough clock has been received.
+	"""
+	def get_phase(self):
+		if self.period is None:
+			return None
+		return (self.last, self.period)
 		
 	def set_input_port(self, port):
 		self.input_port = port
+	
+	"""
+	Record every incoming realtime message into a capture.ClockCapture.
+	"""
+	def set_capture(self, capture):
+		self.capture = capture
+
+"""
+Replays a capture.ClockCapture as if it was arriving on a MIDI input, either at
+the original speed or as fast as possible.
+"""
+class ReplayDispatcher(MIDIInputDispatcher):
+	replay = None
+	fast = False
+	
+	def set_replay(self, capture, fast=False):
+		self.replay = capture
+		self.fast = fast
+	
+	def run(self):
+		start = time.monotonic()
+		first = None
+		for (status, delta_time, stamp) in self.replay.events():
+			if self.quit:
+				return
+			
+			if first is None:
+				first = stamp
+			
+			if not self.fast:
+				# same backoff as HrTimer
+				due = start + (stamp - first)
+				rem = due - time.monotonic()
+				while rem > 0:
+					if self.quit:
+						return
+					time.sleep(rem * 0.925)
+					rem = due - time.monotonic()
+			
+			self.recv_message(([status], delta_time))
+
+"""
+MIDI clock dispatcher with several inputs. The clock comes from one of them;
+everything else is forwarded to the outputs according to compiled routes (see
+routing.py), which lets the Pi double as a MIDI merge box.
+"""
+class MultiInputDispatcher(MIDIInputDispatcher):
+	input_ports = []
+	clock_input = 0
+	tables = []
+	
+	def set_input_ports(self, ports, clock_input=0):
+		self.input_ports = ports
+		self.clock_input = clock_input
+		self.input_port = ports[clock_input] if ports else None
+	
+	def set_routes(self, routes, outputs):
+		self.tables = routing.compile_routes(routes, len(self.input_ports), outputs)
+	
+	def run(self):
+		for (index, port) in enumerate(self.input_ports):
+			port.ignore_types(sysex=False, timing=False, active_sense=True)
+			port.set_callback(functools.partial(self.recv_routed, index))
+		while True:
+			if self.quit:
+				break
+			time.sleep(0.01)
+		
+		for port in self.input_ports:
+			port.cancel_callback()
+	
+	def recv_routed(self, index, result, data=None):
+		message = result[0]
+		if message[0] >= MSG_CLOCK_BEAT:
+			if index == self.clock_input:
+				self.recv_message(result)
+			return
+		
+		entry = self.tables[index][message[0]]
+		if entry:
+			for (output, status) in entry:
+				if status == message[0]:
+					output.route(message)
+				else:
+					output.route([status] + message[1:])
+
+"""
+MIDI input dispatcher with a flywheel. It tracks the tempo and phase of the
+incoming clock, and if no clock arrives for failover_ticks tick periods while
+the transport is running, an internal clock takes over at the last tempo and
+on the same tick grid. The ticks that went missing while we were waiting are
+made up for, so downstream devices don't lose their place in the song: the
+flywheel runs at CATCH_UP_SPEED times the tempo until it is back on the grid,
+rather than sending them in a burst that slaves would take for a tempo spike.
+
+When the source comes back, its first tick is matched against the internal
+grid: if it is closer to the tick the flywheel just sent, it is swallowed,
+otherwise it stands in for the next one. Either way no tick is doubled or
+skipped, and the phase moves by less than half a tick.
+"""
+class FailoverDispatcher(MultiInputDispatcher):
+	failover_ticks = 3
+	listener = None
+	state = CLOCK_WAITING
+	
+	# clocks needed to trust the tempo estimate
+	ARM_TICKS = 24
+	
+	# how much faster than the tempo the flywheel catches up on missed ticks
+	CATCH_UP_SPEED = 1.5
+	
+	def __init__(self, callback):
+		super(FailoverDispatcher, self).__init__(callback)
+		self.lock = threading.Lock()
+		# grid time of the next flywheel tick, and when it is to be sent
+		self.next_deadline = None
+		self.send_at = None
+	
+	def set_failover(self, ticks, listener=None):
+		self.failover_ticks = ticks
+		self.listener = listener
+	
+	def _set_state(self, state):
+		if state != self.state:
+			self.state = state
+			if self.listener:
+				self.listener(state)
+	
+	"""
+	Everything that reaches the router, from here or from the flywheel, is
+	sent under the lock: a transport change can't interleave with a flywheel
+	tick, and the router's trace buffer only ever has one writer at a time.
+	"""
+	def recv_message(self, result, data=None):
+		status = result[0][0]
+		with self.lock:
+			if status == MSG_CLOCK_BEAT:
+				self._recv_clock(time.monotonic(), result)
+				return
+			
+			if status in (MSG_CLOCK_START, MSG_CLOCK_CONTINUE):
+				self._set_state(CLOCK_SOURCE if self.period else CLOCK_WAITING)
+			elif status == MSG_CLOCK_STOP:
+				# a deliberate stop must not trigger the flywheel
+				self._set_state(CLOCK_STOPPED)
+			
+			super(FailoverDispatcher, self).recv_message(result, data)
+	
+	def _recv_clock(self, now, result):
+		if self.state == CLOCK_FLYWHEEL:
+			self._set_state(CLOCK_SOURCE)
+			# the flywheel already sent the tick this one stands for
+			if now - (self.next_deadline - self.period) < self.period / 2:
+				self.last = now
+				if self.capture:
+					self.capture.record(MSG_CLOCK_BEAT, result[1], now)
+				return
+			# Forwarded as usual. The gap since the last source clock is
+			# too long to count towards the period estimate, and the
+			# flywheel didn't touch self.last, so the estimate is unchanged.
+			super(FailoverDispatcher, self).recv_message(result)
+			return
+		
+		# this also updates the period estimate
+		super(FailoverDispatcher, self).recv_message(result)
+		
+		if self.state == CLOCK_WAITING and self.clocks >= self.ARM_TICKS:
+			self._set_state(CLOCK_SOURCE)
+	
+	def run(self):
+		for (index, port) in enumerate(self.input_ports):
+			port.ignore_types(sysex=False, timing=False, active_sense=True)
+			port.set_callback(functools.partial(self.recv_routed, index))
+		
+		while not self.quit:
+			with self.lock:
+				rem = self._poll(time.monotonic())
+			# same backoff as HrTimer, but never sleep so long that we'd miss
+			# the stop request
+			time.sleep(min(max(rem * 0.925, 0), 0.01))
+		
+		for port in self.input_ports:
+			port.cancel_callback()
+	
+	def get_phase(self):
+		with self.lock:
+			if self.state == CLOCK_FLYWHEEL:
+				return (self.next_deadline - self.period, self.period)
+			return super(FailoverDispatcher, self).get_phase()
+	
+	"""
+	Check for a timeout or a due flywheel tick. Returns the time until
+	something needs to happen next.
+	"""
+	def _poll(self, now):
+		if self.state == CLOCK_SOURCE:
+			deadline = self.last + self.period * self.failover_ticks
+			if now < deadline:
+				return deadline - now
+			
+			# take over, starting with the first tick that went missing
+			self._set_state(CLOCK_FLYWHEEL)
+			self.next_deadline = self.last + self.period
+			self.send_at = now
+		
+		if self.state == CLOCK_FLYWHEEL:
+			if now >= self.send_at:
+				self.callback()
+				self.next_deadline += self.period
+				# while behind the grid, ticks are only squeezed together
+				# as far as the catch-up speed allows
+				self.send_at = max(self.next_deadline,
+					now + self.period / self.CATCH_UP_SPEED)
+			return self.send_at - now
+		
+		return 0.01
 
 """
 High resolution interval timer. Runs the provided callback at precise intervals,
@@ -214,6 +1050,8 @@ class HrTimer:
 	interval = 0.0
 	callback = None
 	should_stop = False
+	deadline = 0.0
+	trace = None
 	
 	"""
 	Constructor
@@ -228,8 +1066,21 @@ class HrTimer:
 		self.interval = interval
 		self.callback = callback
 	
-	def run(self):
-		last = time.monotonic()
+	"""
+	Run the timer until should_stop is set. The first tick is sent at the
+	given time.monotonic() time, or right away.
+	"""
+	def run(self, first=None):
+		trace = self.trace
+		last = first if first is not None else time.monotonic()
+		rem = last - time.monotonic()
+		while rem > 0:
+			if self.should_stop:
+				return
+			time.sleep(rem * 0.925)
+			rem = last - time.monotonic()
+		
+		self.deadline = last
 		self.callback()
 		while True:
 			if self.should_stop:
@@ -238,11 +1089,21 @@ class HrTimer:
 			now = time.monotonic()
 			rem = (last + self.interval) - now
 			if rem <= 0:
-				self.callback()
 				# Base the next runtime on the last runtime, which ties back to
 				# the start time. This guarantees that we stay very close to
-				# alignment to our original start time.
+				# alignment to our original start time. This is done before the
+				# callback so that an interval it sets applies from the next
+				# tick on.
 				last += self.interval
+				# expose the deadline being serviced so that callbacks can
+				# measure how late they are running
+				self.deadline = last
+				self.callback()
+				if trace:
+					trace.tick(self.deadline, now, time.monotonic())
+			elif trace:
+				time.sleep(rem * 0.925)
+				trace.span(SPAN_SLEEP, now, time.monotonic())
 			else:
 				time.sleep(rem * 0.925)
 
@@ -254,103 +1115,308 @@ class ClickOutput(threading.Thread):
 	port = None
 	index = 0
 	router = None
+	trace = None
+	barrier = None
 	
 	def __init__(self, port, index, router):
-		super(self.__class__, self).__init__()
-		self.queue = Queue()
+		super(self.__class__, self).__init__(name='output %d' % (index))
+		self.queue = ClickQueue(*router.output_policy)
 		self.port = port
 		self.index = index
 		self.router = router
 		
 	def start(self):
-		self.port.send_message([MSG_CLOCK_START])
 		super(self.__class__, self).start()
 	
+	"""
+	Transport messages are sent when they are published, i.e. by every output
+	at the same time, rather than when the thread starts or is joined.
+	"""
 	def run(self):
+		wait_ready(self.barrier)
+		if self.trace:
+			self._run_traced()
+			return
+		
+		while True:
+			(msg, count) = self.queue.get()
+			if msg == 'click':
+				for i in range(0, count):
+					self.port.send_message([MSG_CLOCK_BEAT])
+			elif msg == 'route':
+				self.port.send_message(count)
+			elif msg in TRANSPORT_MESSAGES:
+				self.port.send_message([TRANSPORT_MESSAGES[msg]])
+				if msg == 'stop':
+					return
+	
+	def _run_traced(self):
+		trace = self.trace
 		while True:
-			msg = self.queue.get()
+			(msg, count) = self.queue.get()
+			start = time.monotonic()
 			if msg == 'click':
-				self.port.send_message([MSG_CLOCK_BEAT])
+				trace.instant(EVENT_WAKE, start, count)
+				for i in range(0, count):
+					self.port.send_message([MSG_CLOCK_BEAT])
+				trace.span(SPAN_SEND, start, time.monotonic(), MSG_CLOCK_BEAT)
+			elif msg == 'route':
+				self.port.send_message(count)
+				trace.span(SPAN_SEND, start, time.monotonic(), count[0])
+			elif msg in TRANSPORT_MESSAGES:
+				self.port.send_message([TRANSPORT_MESSAGES[msg]])
+				trace.span(SPAN_SEND, start, time.monotonic(), TRANSPORT_MESSAGES[msg])
+				if msg == 'stop':
+					return
+	
+	"""
+	Queue a routed (non-clock) message. Clock always goes out first, so a clock
+	can at most wait for the one routed message being sent at the time.
+	"""
+	def route(self, message):
+		self.queue.put_low(message)
+	
+	"""
+	Wait for the worker to exit, after the router has published 'stop'.
+	"""
+	def stop(self):
+		self.join()
+	
+	def set_multiplier(self, multiplier):
+		pass
+	
+	def set_pattern(self, pattern):
+		pass
+
+"""
+Clock output through a scheduling MIDI sequencer (see sequencer.py).
+
+Instead of sending each clock when it is due, this worker keeps the next few
+ticks (the window) queued in the sequencer with their exact timestamps, taken
+from the router's tick grid, and the kernel delivers them. Python only has to
+top up the window once per tick, and a delay in doing so only shrinks the
+window rather than delaying a clock.
+
+When the tick interval changes, the ticks still queued on the old grid are
+flushed and scheduled again on the new one. On stop, the queued ticks are
+flushed and a stop message is sent.
+"""
+class SequencerOutput(threading.Thread):
+	queue = None
+	backend = None
+	router = None
+	trace = None
+	barrier = None
+	window = SEQUENCER_WINDOW
+	
+	def __init__(self, backend, router, window=SEQUENCER_WINDOW):
+		super(self.__class__, self).__init__(name='sequencer')
+		self.queue = ClickQueue(POLICY_COALESCE)
+		self.backend = backend
+		self.router = router
+		self.window = window
+		# (tick, time) of the ticks handed to the sequencer that may not have
+		# been delivered yet
+		self.pending = deque()
+		self.scheduled = 0
+		self.interval = None
+	
+	def start(self):
+		self.backend.start()
+		super(self.__class__, self).start()
+	
+	def run(self):
+		wait_ready(self.barrier)
+		first = self.router.start_time
+		if first is not None:
+			self._schedule_start(first)
+		
+		stopping = False
+		while True:
+			(msg, count) = self.queue.get()
+			if msg == 'click':
+				if not stopping:
+					self._top_up()
+			elif msg == 'start' and first is None:
+				self.backend.schedule(MSG_CLOCK_START, time.monotonic())
+				self.backend.commit()
+			elif msg == 'stopping':
+				self._schedule_stop(self.router.stop_time)
+				stopping = True
 			elif msg == 'stop':
+				if not stopping:
+					self._schedule_stop(time.monotonic())
 				return
 	
+	"""
+	Send the stop message at the given time, in place of the tick due then:
+	the ticks queued from that time on are dropped, like the ones the router
+	never sends.
+	"""
+	def _schedule_stop(self, when):
+		now = time.monotonic()
+		# anything within half a tick of the stop is the tick it replaces
+		limit = when - self.interval / 2 if self.interval else when
+		keep = [t for (tick, t) in self.pending if now < t < limit]
+		self.backend.flush()
+		for t in keep:
+			self.backend.schedule(MSG_CLOCK_BEAT, t)
+		self.backend.schedule(MSG_CLOCK_STOP, when)
+		self.backend.commit()
+		self.pending.clear()
+	
+	"""
+	Queue the start message and the first window of ticks for the start
+	deadline, before the timer gets there.
+	"""
+	def _schedule_start(self, first):
+		interval = self.router.dispatcher.get_phase()[1]
+		self.backend.schedule(MSG_CLOCK_START, first)
+		for tick in range(1, self.window + 1):
+			when = first + (tick - 1) * interval
+			self.backend.schedule(MSG_CLOCK_BEAT, when)
+			self.pending.append((tick, when))
+			self.scheduled = tick
+		self.interval = interval
+		self.backend.commit()
+	
+	def _top_up(self):
+		phase = self.router.get_phase()
+		if not phase:
+			return
+		
+		(ticks, last, interval) = phase
+		start = time.monotonic()
+		pending = self.pending
+		while pending and pending[0][1] <= start:
+			pending.popleft()
+		
+		if interval != self.interval:
+			if pending:
+				# the tempo changed: whatever is still queued is on the old
+				# grid
+				self.backend.flush()
+				self.scheduled = pending[0][0] - 1
+				pending.clear()
+			self.interval = interval
+		
+		for tick in range(self.scheduled + 1, ticks + self.window + 1):
+			when = last + (tick - ticks) * interval
+			self.backend.schedule(MSG_CLOCK_BEAT, when)
+			pending.append((tick, when))
+			self.scheduled = tick
+		self.backend.commit()
+		
+		if self.trace:
+			self.trace.span(SPAN_SEND, start, time.monotonic(), MSG_CLOCK_BEAT)
+	
+	"""
+	Wait for the worker to exit, after the router has published 'stop'.
+	"""
 	def stop(self):
-		self.queue.put('stop')
 		self.join()
-		self.port.send_message([MSG_CLOCK_STOP])
+		self.backend.stop()
 	
 	def set_multiplier(self, multiplier):
 		pass
+	
+	def set_pattern(self, pattern):
+		pass
 
 """
 Output thread for the click sound that will be played through the speakers.
+
+Clicks are looked up per tick in a ClickSchedule, which holds buffers that have
+already been rendered in the device's format; nothing is decoded or converted
+on this thread. They are played on the process's standby device (see
+audio.py), which stays open between runs.
 """
 class ClickSound(threading.Thread):
 	queue = None
 	multiplier = 1
+	pattern = None
+	voice = None
+	device = None
+	schedule = None
+	trace = None
+	barrier = None
 
-	def __init__(self, multiplier):
-		super(self.__class__, self).__init__()
-		self.queue = Queue()
+	def __init__(self, multiplier, policy=(POLICY_COALESCE, 0), pattern=None, voice=None):
+		super(self.__class__, self).__init__(name='sound')
+		self.queue = ClickQueue(*policy)
 		self.multiplier = multiplier
+		self.pattern = pattern if pattern else voices.ClickPattern(subdivision=multiplier)
+		self.voice = voice
 
 	def start(self):
 		super(self.__class__, self).start()
 
 	def run(self):
-		# search the system for a click file
-		paths = [
-			os.path.dirname(os.path.realpath(__file__)) + '/data/click.wav',
-			'/usr/local/share/piclicktrack/click.wav',
-			'/usr/share/piclicktrack/click.wav'
-		]
+		if not self.voice:
+			self.voice = voices.default_voice()
 		
-		path = None
+		try:
+			device = audio.standby()
+		except audio.AudioError as e:
+			sys.stderr.write("%s, no audible click\n" % (e.message))
+			device = None
 		
-		for p in paths:
-			print(p)
-			if os.path.exists(p):
-				path = p
-		
-		if not path:
-			return
-		
-		wavfile = wave.open(path, 'rb')
-		(num_channels, sample_width, framerate, num_frames, comptype, compname) = wavfile.getparams()
-		data = wavfile.readframes(num_frames)
-		wavfile.close()
+		if device:
+			self.device = device.config()
+			voices.voice_cache.configure(*self.device)
+			self._compile()
+			# wake the writer while the other workers get ready
+			device.resume()
+		wait_ready(self.barrier)
+		trace = self.trace
 		i = 0
 
-		alsadev = alsaaudio.PCM()
-		alsadev.setperiodsize(num_frames)
-		if sample_width == 1:
-			alsadev.setformat(alsaaudio.PCM_FORMAT_U8)
-		elif sample_width == 2:
-			alsadev.setformat(alsaaudio.PCM_FORMAT_S16_LE)
-		elif sample_width == 3:
-			alsadev.setformat(alsaaudio.PCM_FORMAT_S24_LE)
-		elif sample_width == 4:
-			alsadev.setformat(alsaaudio.PCM_FORMAT_S32_LE)
-
 		while True:
-			msg = self.queue.get()
+			(msg, count) = self.queue.get()
 			if msg == 'click':
-				if i % (24/self.multiplier) == 0:
-					alsadev.write(data)
+				# If we fell behind, only the most recent tick is worth
+				# playing; a late click is worse than a missing one.
+				i += count - 1
+				data = self.schedule.at(i) if device else None
+				if data:
+					if trace:
+						start = time.monotonic()
+						trace.instant(EVENT_WAKE, start, count)
+						device.play(data)
+						trace.span(SPAN_WRITE, start, time.monotonic(), len(data))
+					else:
+						device.play(data)
 
 				i += 1
-			elif msg == 'start':
+			elif msg in ('start', 'bar'):
+				# the schedule is indexed from the first tick of a bar
 				i = 0
 			elif msg == 'stop':
-				alsadev.close()
+				# the device stays open, paused until the next start
+				if device:
+					device.pause()
 				return
 
+	"""
+	Wait for the worker to exit, after the router has published 'stop'.
+	"""
 	def stop(self):
-		self.queue.put('stop')
 		self.join()
 	
+	def _compile(self):
+		# swapped in with a single assignment, so the audio thread never sees
+		# a half-built schedule
+		self.schedule = voices.ClickSchedule(self.pattern, self.voice, *self.device)
+	
 	def set_multiplier(self, multiplier):
 		self.multiplier = multiplier
+		if multiplier != self.pattern.subdivision:
+			self.set_pattern(voices.ClickPattern(self.pattern.beats, multiplier))
+	
+	def set_pattern(self, pattern):
+		self.pattern = pattern
+		if self.device:
+			self._compile()
 
 """
 Output thread for a custom callback
@@ -358,26 +1424,274 @@ Output thread for a custom callback
 class ClickCallback(threading.Thread):
 	queue = None
 	callback = None
+	trace = None
+	barrier = None
 	
-	def __init__(self, callback):
-		super(self.__class__, self).__init__()
-		self.queue = Queue()
+	def __init__(self, callback, policy=(POLICY_COALESCE, 0)):
+		super(self.__class__, self).__init__(name='callback')
+		self.queue = ClickQueue(*policy)
 		self.callback = callback
 		
 	def start(self):
 		super(self.__class__, self).start()
 	
+	"""
+	The callback receives the number of ticks it is being run for, which is
+	more than one if it was too slow to keep up and ticks were coalesced.
+	"""
 	def run(self):
+		wait_ready(self.barrier)
+		trace = self.trace
 		while True:
-			msg = self.queue.get()
+			(msg, count) = self.queue.get()
 			if msg == 'click':
-				self.callback()
+				if trace:
+					start = time.monotonic()
+					self.callback(count)
+					trace.span(SPAN_CALLBACK, start, time.monotonic(), count)
+				else:
+					self.callback(count)
 			elif msg == 'stop':
 				return
 	
+	"""
+	Wait for the worker to exit, after the router has published 'stop'.
+	"""
 	def stop(self):
-		self.queue.put('stop')
 		self.join()
 	
 	def set_multiplier(self, multiplier):
 		pass
+	
+	def set_pattern(self, pattern):
+		pass
+
+"""
+Broadcast sequence of clock messages.
+
+The dispatcher publishes every message once, and every worker reads it from
+here, so publishing costs the same no matter how many workers there are.
+Messages go into a ring indexed by a monotonically increasing sequence number.
+Workers remember the next sequence number they want, and catch up on whatever
+was published since.
+
+Messages other than clicks ('start', 'bar', 'stop' and so on) are also kept,
+with their sequence numbers, in a list that is never overwritten, so a worker
+that falls a whole ring behind loses only clicks. There are a handful of them
+per run, and the sequence is replaced on every start.
+
+Waiting workers block on the current gate, a lock held by the sequence.
+Publishing puts a new gate in place and releases the old one. Each worker
+that gets through the old gate releases it again for the next one, so a
+single release wakes all of them. The publisher makes no system call that
+could hand the interpreter lock to a worker halfway through a tick.
+
+There can be more than one publisher: the clock thread, the MIDI input
+callbacks waking workers for routed messages, and a failover flywheel. Swapping
+the gate is serialized by a lock that is only ever held for the swap; without
+it, two threads could release the same gate, and the second release fails
+and leaves the new gate orphaned.
+"""
+class TickSequence:
+	seq = 0
+	size = SEQUENCE_SIZE
+	
+	def __init__(self, size=SEQUENCE_SIZE):
+		self.size = size
+		self.ring = [None] * size
+		self.seq = 0
+		self.gate = self._new_gate()
+		self.lock = threading.Lock()
+		# sequence numbers and messages of everything but clicks
+		self.control_seqs = []
+		self.controls = []
+	
+	def _new_gate(self):
+		gate = threading.Lock()
+		gate.acquire()
+		return gate
+	
+	def publish(self, msg):
+		with self.lock:
+			self.ring[self.seq % self.size] = msg
+			if msg != 'click':
+				self.controls.append(msg)
+				self.control_seqs.append(self.seq)
+			# Bump the sequence number before replacing the gate: a worker that
+			# picks up the new gate is then sure to see the message.
+			self.seq += 1
+			self._swap_gate()
+	
+	"""
+	Wake every waiting worker, e.g. to look at its routed messages.
+	"""
+	def wake(self):
+		with self.lock:
+			self._swap_gate()
+	
+	def _swap_gate(self):
+		(old, self.gate) = (self.gate, self._new_gate())
+		old.release()
+	
+	"""
+	Returns the messages other than clicks published with sequence numbers
+	from start up to (not including) end.
+	"""
+	def controls_between(self, start, end):
+		seqs = self.control_seqs
+		first = bisect.bisect_left(seqs, start)
+		last = bisect.bisect_left(seqs, end, first)
+		return self.controls[first:last]
+	
+	"""
+	Block until the next wake(), unless the gate has been passed already.
+	"""
+	@staticmethod
+	def wait(gate):
+		gate.acquire()
+		gate.release()
+
+"""
+A worker's view of the TickSequence.
+
+Only clicks count towards the bound; control messages such as 'stop' are always
+delivered. What happens to clicks the worker has fallen behind on depends on the
+policy, which is applied when the worker catches up:
+
+POLICY_KEEP_ALL
+	every click is delivered on its own
+POLICY_DROP_OLDEST
+	at most maxsize clicks are kept pending; older ones are discarded
+POLICY_COALESCE
+	clicks are merged into a single pending entry (the bound is ignored)
+
+The dispatcher never waits for a worker. If a worker falls further behind
+than the size of the ring, the ticks it missed are counted as dropped whatever
+the policy; the control messages among them are still delivered, in order.
+
+get() returns a tuple of (message, count), where count is the number of ticks
+a coalesced click stands for and 1 otherwise. Dropped clicks are counted in
+the dropped attribute.
+
+put_low() queues a routed MIDI message for this worker only, at low priority:
+it is only returned, as ('route', message), once there is nothing else
+pending. At most ROUTE_BACKLOG of them are kept; newer ones are dropped and
+counted.
+"""
+class ClickQueue:
+	policy = POLICY_KEEP_ALL
+	maxsize = 0
+	dropped = 0
+	sequence = None
+	
+	def __init__(self, policy=POLICY_KEEP_ALL, maxsize=0):
+		self.policy = policy
+		self.maxsize = maxsize
+		self.next = 0
+		# entries are [message, count] pairs
+		self.items = deque()
+		self.low = deque()
+		self.clicks = 0
+		self.dropped = 0
+	
+	"""
+	Start reading from a TickSequence at its current position.
+	"""
+	def attach(self, sequence):
+		self.sequence = sequence
+		self.next = sequence.seq
+	
+	def put_low(self, message):
+		if len(self.low) >= ROUTE_BACKLOG:
+			self.dropped += 1
+			return
+		
+		self.low.append(message)
+		# Messages for several outputs usually arrive together, and the first
+		# wakeup gets all workers going; the rest find no one waiting.
+		self.sequence.wake()
+	
+	def get(self):
+		while True:
+			if not self.items:
+				self._catch_up()
+			
+			if self.items:
+				(msg, count) = self.items.popleft()
+				if msg == 'click':
+					self.clicks -= 1
+				return (msg, count)
+			
+			if self.low:
+				return ('route', self.low.popleft())
+			
+			self._wait()
+	
+	"""
+	Move everything published since we last looked into the pending items,
+	applying the policy.
+	"""
+	def _catch_up(self):
+		sequence = self.sequence
+		seq = sequence.seq
+		items = self.items
+		missed = seq - self.next - sequence.size
+		if missed > 0:
+			# the clicks are gone, but the control messages are kept aside
+			controls = sequence.controls_between(self.next, self.next + missed)
+			for msg in controls:
+				items.append([msg, 1])
+			self.dropped += missed - len(controls)
+			self.next += missed
+		
+		ring = sequence.ring
+		for n in range(self.next, seq):
+			msg = ring[n % sequence.size]
+			if msg != 'click':
+				items.append([msg, 1])
+				continue
+			
+			if self.policy == POLICY_COALESCE:
+				# merge into the pending click, unless a control message came
+				# after it
+				if items and items[-1][0] == 'click':
+					items[-1][1] += 1
+					continue
+			elif self.policy == POLICY_DROP_OLDEST and 0 < self.maxsize <= self.clicks:
+				for item in items:
+					if item[0] == 'click':
+						items.remove(item)
+						break
+				self.clicks -= 1
+				self.dropped += 1
+			
+			items.append(['click', 1])
+			self.clicks += 1
+		
+		self.next = seq
+	
+	"""
+	Sleep until something is published or a routed message arrives.
+	"""
+	def _wait(self):
+		# Pick up the gate before checking for work, so that anything
+		# published or routed in between opens the gate we wait on.
+		gate = self.sequence.gate
+		if self.sequence.seq != self.next or self.low:
+			return
+		
+		TickSequence.wait(gate)
+
+"""
+Wait at a router's start barrier until every worker has its device ready. If
+one doesn't make it in time the barrier breaks, and the others go on without
+it.
+"""
+def wait_ready(barrier):
+	if barrier is None:
+		return
+	
+	try:
+		barrier.wait(READY_TIMEOUT)
+	except threading.BrokenBarrierError:
+		pass
@@ -8,7 +8,16 @@ except ImportError:
     from PyQt4 import QtGui, QtCore
 
 import clicktrack.master as ctmaster
-from clicktrack.dispatcher import ClickRouter, TimedDispatcher, MIDIInputDispatcher
+from clicktrack import audio
+from clicktrack.dispatcher import ClickRouter, MIDIInputDispatcher, MultiInputDispatcher, FailoverDispatcher
+from clicktrack.dispatcher import CLOCK_WAITING, CLOCK_SOURCE, CLOCK_FLYWHEEL, CLOCK_STOPPED
+from clicktrack.routing import Route
+from clicktrack.isolated import IsolatedClickRouter
+from clicktrack.aio import AsyncClickRouter
+from clicktrack.capture import ClockCapture
+from clicktrack.control import MasterController, ControlServer
+from clicktrack.indicator import BeatIndicator
+from clicktrack.sequencer import AlsaSequencerBackend, SequencerError
 
 def munge_widget_size(target):
 	policy = QtGui.QSizePolicy()
@@ -33,13 +42,44 @@ def munge_widget_size(target):
 		if isinstance(c, QtGui.QLabel):
 			c.setAlignment(QtCore.Qt.AlignCenter | QtCore.Qt.AlignVCenter)
 
+# Label for each click multiplier (clicks per beat)
+SUBDIVISION_LABELS = {
+	1: '1/4',
+	2: '1/8',
+	3: '1/8T',
+	4: '1/16',
+}
+
+# Thru mode failover state display
+CLOCK_STATE_LABELS = {
+	CLOCK_WAITING: 'Waiting for clock',
+	CLOCK_SOURCE: 'External clock',
+	CLOCK_FLYWHEEL: 'SOURCE LOST - internal clock',
+	CLOCK_STOPPED: 'Stopped by source',
+}
+
 """
 Primary widget that constructs the UI chrome and every stage inside it.
 """
 class MainWidget(QtGui.QWidget):
-	def __init__(self):
+	engine = 'thread'
+	capture_path = None
+	control = False
+	tracer = None
+	
+	def __init__(self, engine='thread', capture_path=None, control=False, tracer=None):
 		super(self.__class__, self).__init__()
 		
+		self.engine = engine
+		self.capture_path = capture_path
+		self.control = control
+		# only the threaded engine can be traced
+		self.tracer = tracer if engine in ('thread', 'sequencer') else None
+		
+		# get the audio device and the click ready before anyone presses
+		# Start; the isolated engine does this in its own process
+		if engine != 'isolated':
+			audio.prepare()
 		
 		master_layout = QtGui.QVBoxLayout()
 		
@@ -121,17 +161,34 @@ class MasterMode(QtGui.QWidget):
 	song_lbl = None
 	tempo_lbl = None
 	
-	x2_btn = None
+	sub_btn = None
 	start_btn = None
+	indicator = None
 	
 	clicker = None
+	controller = None
+	control_server = None
+	
+	# emitted from the control server thread whenever it changed something
+	changed = QtCore.pyqtSignal()
 	
 	def __init__(self, main_widget):
 		super(self.__class__, self).__init__()
 		
 		self.main_widget = main_widget
 		self.master = ctmaster.ClickMaster()
-		self.clicker = ClickRouter()
+		if main_widget.engine == 'isolated':
+			self.clicker = IsolatedClickRouter()
+		elif main_widget.engine == 'asyncio':
+			self.clicker = AsyncClickRouter()
+		else:
+			self.clicker = ClickRouter()
+			self.clicker.set_tracer(main_widget.tracer)
+			if main_widget.engine == 'sequencer':
+				try:
+					self.clicker.set_sequencer(AlsaSequencerBackend())
+				except SequencerError as e:
+					sys.stderr.write("%s, sending the clock directly\n" % (e.message))
 		
 		layout = QtGui.QVBoxLayout()
 		
@@ -194,10 +251,9 @@ class MasterMode(QtGui.QWidget):
 		# row 3: start/stop button and multiplier
 		start_row = QtGui.QHBoxLayout()
 		
-		self.x2_btn = QtGui.QPushButton('x2')
-		self.x2_btn.setCheckable(True)
-		self.x2_btn.clicked.connect(self.set_multiplier)
-		start_row.addWidget(self.x2_btn)
+		self.sub_btn = QtGui.QPushButton()
+		self.sub_btn.clicked.connect(self.set_multiplier)
+		start_row.addWidget(self.sub_btn)
 		
 		self.start_btn = QtGui.QPushButton("I don't know my state")
 		self.start_btn.clicked.connect(self.toggle)
@@ -213,32 +269,47 @@ class MasterMode(QtGui.QWidget):
 		p.setHorizontalStretch(4)
 		self.start_btn.setSizePolicy(p)
 		
-		self._redraw()
+		# row 4: beat indicator, added after munge_widget_size() so that it
+		# keeps its own fixed height
+		self.indicator = BeatIndicator()
+		self.indicator.setFixedHeight(32)
+		self.indicator.set_source(self.clicker.get_bar_phase)
+		layout.addWidget(self.indicator)
+		
+		self.controller = MasterController(self.master, self.clicker, self.changed.emit)
+		self.changed.connect(self._redraw)
+		# hand the first song to the router, which also draws it
+		self.controller.select_song(self.master.get_song())
+		if main_widget.control:
+			self.control_server = ControlServer(self.controller)
+			self.control_server.start()
 	
 	def start(self):
-		self.clicker.start()
-		self.start_btn.setText('Stop')
+		self.controller.start()
 	
 	def stop(self):
-		self.clicker.stop()
-		self.start_btn.setText('Start')
+		self.controller.stop()
 		
 	def shutdown(self):
+		if self.control_server:
+			self.control_server.stop()
+		
 		if self.clicker.started:
 			self.stop()
+		
+		if isinstance(self.clicker, IsolatedClickRouter):
+			self.clicker.close()
 	
 	def toggle(self):
-		if self.clicker.started:
-			self.stop()
-		else:
-			self.start()
+		self.controller.toggle()
 	
 	def _redraw(self):
+		self.start_btn.setText('Stop' if self.clicker.started else 'Start')
 		self.song_lbl.setText("Song %d/%d" % (self.master.get_song() + 1, self.master.count_songs() + 1))
 		self.tempo_lbl.setText("%d" % (self.master.get_tempo()))
-		self.x2_btn.setChecked(self.master.get_multiplier() == 2)
-		self.clicker.set_tempo(float(self.master.get_tempo()), self.master.get_multiplier())
-		
+		self.sub_btn.setText(SUBDIVISION_LABELS[self.master.get_multiplier()])
+		self.indicator.set_beats(self.master.get_pattern().beats)
+	
 	def _errmsg(self, exception):
 		mbox = QtGui.QMessageBox()
 		mbox.setIcon(QtGui.QMessageBox.Critical)
@@ -247,72 +318,55 @@ class MasterMode(QtGui.QWidget):
 		mbox.setDefaultButton(QtGui.QMessageBox.Ok)
 		mbox.exec_()
 	
+	"""
+	The buttons go through the controller, like remote commands, which
+	applies them to the router and then has us redraw.
+	"""
 	@QtCore.pyqtSlot()
 	def prev_song(self):
-		index = self.master.get_song() - 1
 		try:
-			self.master.select_song(index)
+			self.controller.prev_song()
 		except ctmaster.ClickMasterError as e:
 			pass
-		
-		self._redraw()
 	
 	@QtCore.pyqtSlot()
 	def next_song(self):
-		index = self.master.get_song() + 1
 		try:
-			self.master.select_song(index)
+			self.controller.next_song()
 		except ctmaster.ClickMasterError as e:
 			pass
-		
-		self._redraw()
 	
 	@QtCore.pyqtSlot()
 	def add_song(self):
-		self.master.add_song()
-		self.master.last_song()
-		
-		self._redraw()
+		self.controller.add_song()
 	
-	@QtCore.pyqtSlot()
-	def decrement_tempo_10(self):
+	def _nudge_tempo(self, change):
 		try:
-			self.master.change_tempo(-10)
+			self.controller.nudge_tempo(change)
 		except ctmaster.ClickMasterError as e:
 			self._errmsg(e)
-			
-		self._redraw()
+	
+	@QtCore.pyqtSlot()
+	def decrement_tempo_10(self):
+		self._nudge_tempo(-10)
 	
 	@QtCore.pyqtSlot()
 	def decrement_tempo_1(self):
-		try:
-			self.master.change_tempo(-1)
-		except ctmaster.ClickMasterError as e:
-			self._errmsg(e)
-		self._redraw()
+		self._nudge_tempo(-1)
 	
 	@QtCore.pyqtSlot()
 	def increment_tempo_1(self):
-		try:
-			self.master.change_tempo(1)
-		except ctmaster.ClickMasterError as e:
-			self._errmsg(e)
-		self._redraw()
+		self._nudge_tempo(1)
 	
 	@QtCore.pyqtSlot()
 	def increment_tempo_10(self):
-		try:
-			self.master.change_tempo(10)
-		except ctmaster.ClickMasterError as e:
-			self._errmsg(e)
-		self._redraw()
+		self._nudge_tempo(10)
 	
 	@QtCore.pyqtSlot()
 	def set_multiplier(self):
-		multiplier = 2 if self.x2_btn.isChecked() else 1
-		print("setting multiplier to %d" % (multiplier))
-		self.master.set_multiplier(multiplier)
-		self._redraw()
+		# cycle through quarters, eighths, triplets and sixteenths
+		multiplier = self.master.get_multiplier() % len(SUBDIVISION_LABELS) + 1
+		self.controller.set_multiplier(multiplier)
 	
 
 """
@@ -329,14 +383,19 @@ class ThruModeInputSel(QtGui.QWidget):
 		
 		layout = QtGui.QVBoxLayout()
 		
-		layout.addWidget(QtGui.QLabel('Select a MIDI input device for clock source:'))
+		layout.addWidget(QtGui.QLabel('Select MIDI inputs (last tapped is the clock source):'))
 		
 		self.input_list = QtGui.QListWidget()
+		self.input_list.setSelectionMode(QtGui.QAbstractItemView.MultiSelection)
 		for port in self._get_midi_inputs():
 			self.input_list.addItem(QtGui.QListWidgetItem(port))
 		
 		layout.addWidget(self.input_list)
 		
+		self.failover_btn = QtGui.QPushButton('Failover to internal clock')
+		self.failover_btn.setCheckable(True)
+		layout.addWidget(self.failover_btn)
+		
 		select_btn = QtGui.QPushButton('Continue')
 		select_btn.clicked.connect(self.i_choose_you)
 		layout.addWidget(select_btn)
@@ -360,24 +419,31 @@ class ThruModeInputSel(QtGui.QWidget):
 		
 		return names
 		
+	def _open_input(self, name):
+		for i in range(0, self.midi_input.get_port_count()):
+			if name == self.midi_input.get_port_name(i):
+				port = rtmidi.MidiIn()
+				port.open_port(i)
+				return port
+		
+		raise Exception('MIDI port disappeared before we could open it')
+	
 	@QtCore.pyqtSlot()
 	def i_choose_you(self):
 		chosen = self.input_list.currentItem()
-		if not chosen:
+		if not chosen or not chosen.isSelected():
 			return
-			
-		chosen = chosen.text()
 		
-		opened = False
-		for i in range(0, self.midi_input.get_port_count()):
-			if chosen == self.midi_input.get_port_name(i):
-				self.midi_input.open_port(i)
-				opened = True
+		# the clock source goes first, followed by the inputs to merge
+		names = [chosen.text()]
+		for item in self.input_list.selectedItems():
+			if item.text() not in names:
+				names.append(item.text())
 		
-		if not opened:
-			raise 'MIDI port disappeared before we could open it'
+		ports = [self._open_input(name) for name in names]
 		
-		self.main_widget.thru_ui.set_port(self.midi_input)
+		self.main_widget.thru_ui.set_ports(ports)
+		self.main_widget.thru_ui.failover = self.failover_btn.isChecked()
 		self.main_widget.show_child(self.main_widget.thru_ui)
 
 """
@@ -386,9 +452,17 @@ Thru mode UI
 class ThruMode(QtGui.QWidget):
 	main_widget = None
 	port = None
+	ports = []
 	tempo_label = None
 	clicker = None
 	detector = None
+	capture = None
+	failover = False
+	clock_label = None
+	indicator = None
+	
+	# emitted from the dispatcher thread when the clock source state changes
+	clock_state_changed = QtCore.pyqtSignal(str)
 	
 	def __init__(self, main_widget):
 		super(self.__class__, self).__init__()
@@ -404,29 +478,71 @@ class ThruMode(QtGui.QWidget):
 		self.tempo_label.setAlignment(QtCore.Qt.AlignCenter | QtCore.Qt.AlignVCenter)
 		layout.addWidget(self.tempo_label)
 		
+		self.clock_label = QtGui.QLabel('')
+		self.clock_label.setAlignment(QtCore.Qt.AlignCenter | QtCore.Qt.AlignVCenter)
+		layout.addWidget(self.clock_label)
+		
+		self.indicator = BeatIndicator()
+		self.indicator.setFixedHeight(48)
+		layout.addWidget(self.indicator)
+		
 		self.setLayout(layout)
 		
+		self.clock_state_changed.connect(self.show_clock_state)
+		
 		self.main_widget = main_widget
 	
 	def start(self):
 		if not self.port:
 			raise 'No port selected'
 		
-		self.clicker = ClickRouter(MIDIInputDispatcher)
+		# with more than one input, merge everything but the clock from all of
+		# them into every output
+		backend = MultiInputDispatcher if len(self.ports) > 1 else MIDIInputDispatcher
+		if self.failover:
+			backend = FailoverDispatcher
+		if self.main_widget.engine == 'asyncio':
+			self.clicker = AsyncClickRouter(backend)
+		else:
+			self.clicker = ClickRouter(backend)
+			self.clicker.set_tracer(self.main_widget.tracer)
 		self.clicker.set_input_port(self.port)
+		self.clicker.set_input_ports(self.ports, 0)
+		self.clicker.set_routes([Route()] if len(self.ports) > 1 else [])
+		self.clicker.set_failover(ClickRouter.failover_ticks, self.clock_state_changed.emit)
+		self.show_clock_state(CLOCK_WAITING if self.failover else '')
+		if self.main_widget.capture_path:
+			self.capture = ClockCapture()
+			self.clicker.set_capture(self.capture)
 		self.clicker.start(self.update_tempo)
+		self.indicator.set_source(self.clicker.get_bar_phase)
 	
 	def shutdown(self):
 		if not self.port:
 			return
 			
+		self.indicator.set_source(None)
 		self.clicker.stop()
+		
+		if self.capture:
+			self.capture.save(self.main_widget.capture_path)
 	
 	def set_port(self, port):
-		self.port = port
+		self.set_ports([port])
+	
+	"""
+	Set the input ports; the first one is the clock source.
+	"""
+	def set_ports(self, ports):
+		self.ports = ports
+		self.port = ports[0]
+	
+	@QtCore.pyqtSlot(str)
+	def show_clock_state(self, state):
+		self.clock_label.setText(CLOCK_STATE_LABELS.get(state, ''))
 	
-	def update_tempo(self):
-		self.detector.beat()
+	def update_tempo(self, ticks=1):
+		self.detector.beat(ticks)
 		try:
 			tempo = round(self.detector.get_tempo())
 			self.tempo_label.setText("%d" % (tempo))
@@ -441,9 +557,9 @@ class MainUI:
 	main_widget = False
 	app = False
 	
-	def __init__(self):
+	def __init__(self, engine='thread', capture_path=None, control=False, tracer=None):
 		self.app = QtGui.QApplication(sys.argv)
-		self.main_widget = MainWidget()
+		self.main_widget = MainWidget(engine, capture_path, control, tracer)
 	
 	"""
 	Run the application.
@@ -0,0 +1,197 @@
+import math
+import time
+
+try:
+    from PyQt5 import QtWidgets, QtGui, QtCore
+except ImportError:
+    from PyQt4 import QtGui, QtCore
+    QtWidgets = QtGui
+
+"""
+Beat indicator.
+
+Flashing a light from the click callback means flashing whenever the GUI
+thread gets round to a queued signal, which can be tens of milliseconds after
+the beat. BeatIndicator instead asks the router where the clock is (see
+ClickRouter.get_bar_phase()), works out when the next beat is due and arms a
+single-shot timer for exactly that moment. Between beats it does not wake up
+at all.
+
+Each cell of the indicator is drawn once per size into a pixmap; a beat only
+blits the one or two cells that changed, and never more often than the
+display can show (the 3.5" SPI TFTs refresh at about 25fps).
+"""
+
+# cell states
+CELL_OFF     = 0
+CELL_CURRENT = 1
+CELL_FLASH   = 2
+CELL_ACCENT  = 3
+
+COLORS = {
+	CELL_OFF: QtGui.QColor(48, 48, 48),
+	CELL_CURRENT: QtGui.QColor(0, 96, 0),
+	CELL_FLASH: QtGui.QColor(0, 230, 0),
+	CELL_ACCENT: QtGui.QColor(255, 64, 32),
+}
+
+DEFAULT_FPS = 25
+
+# seconds a beat stays lit
+FLASH_LENGTH = 0.1
+
+# how often to look for a clock while none is running, in seconds
+IDLE_POLL = 0.25
+
+# the clock is considered gone after this many missing ticks
+STALE_TICKS = 12
+
+PPQN = 24
+
+class BeatIndicator(QtWidgets.QWidget):
+	beats = 4
+	source = None
+	max_fps = DEFAULT_FPS
+
+	"""
+	@param int
+		Beats per bar
+	@param int
+		Maximum repaints per second
+	"""
+	def __init__(self, beats=4, max_fps=DEFAULT_FPS, parent=None):
+		super(BeatIndicator, self).__init__(parent)
+		self.beats = beats
+		self.max_fps = max_fps
+		self.states = [CELL_OFF] * beats
+		self.cells = []
+		self.pixmaps = {}
+		self.last_paint = 0.0
+
+		# we paint every pixel ourselves, so Qt need not clear the background
+		self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent)
+		self.setMinimumHeight(24)
+
+		self.timer = QtCore.QTimer(self)
+		self.timer.setSingleShot(True)
+		if hasattr(self.timer, 'setTimerType'):
+			self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+		self.timer.timeout.connect(self._tick)
+
+	"""
+	Set the callable that returns the clock phase: (ticks since the first
+	tick of a bar, time of the last tick, tick interval) or None, i.e. a
+	router's get_bar_phase.
+	"""
+	def set_source(self, source):
+		self.source = source
+		if self.isVisible():
+			self._tick()
+
+	def set_beats(self, beats):
+		if beats == self.beats:
+			return
+		self.beats = beats
+		self.states = [CELL_OFF] * beats
+		self._layout()
+		self.update()
+
+	def showEvent(self, event):
+		self._tick()
+
+	def hideEvent(self, event):
+		self.timer.stop()
+
+	def resizeEvent(self, event):
+		self._layout()
+
+	"""
+	Compute the cell rectangles and render one pixmap per cell state.
+	"""
+	def _layout(self):
+		width = self.width() // self.beats
+		height = self.height()
+		offset = (self.width() - width * self.beats) // 2
+		self.cells = [QtCore.QRect(offset + i * width, 0, width, height)
+			for i in range(0, self.beats)]
+
+		background = self.palette().color(QtGui.QPalette.Window)
+		margin = max(2, min(width, height) // 8)
+		self.pixmaps = {}
+		for (state, color) in COLORS.items():
+			pixmap = QtGui.QPixmap(max(width, 1), max(height, 1))
+			pixmap.fill(background)
+			painter = QtGui.QPainter(pixmap)
+			painter.setRenderHint(QtGui.QPainter.Antialiasing)
+			painter.setPen(QtCore.Qt.NoPen)
+			painter.setBrush(color)
+			painter.drawRoundedRect(margin, margin, width - 2 * margin,
+				height - 2 * margin, margin, margin)
+			painter.end()
+			self.pixmaps[state] = pixmap
+
+	def paintEvent(self, event):
+		painter = QtGui.QPainter(self)
+		area = event.rect()
+		painter.fillRect(area, self.palette().color(QtGui.QPalette.Window))
+		for (i, cell) in enumerate(self.cells):
+			if cell.intersects(area):
+				painter.drawPixmap(cell.topLeft(), self.pixmaps[self.states[i]])
+		painter.end()
+
+	"""
+	Show the given beat of the bar (None for no clock), lit or not, and
+	repaint only the cells that changed. Returns whether anything changed.
+	"""
+	def _show(self, beat, lit):
+		states = [CELL_OFF] * self.beats
+		if beat is not None:
+			if lit:
+				states[beat] = CELL_ACCENT if beat == 0 else CELL_FLASH
+			else:
+				states[beat] = CELL_CURRENT
+
+		changed = False
+		for (i, state) in enumerate(states):
+			if state != self.states[i] and i < len(self.cells):
+				self.update(self.cells[i])
+				changed = True
+		self.states = states
+		return changed
+
+	"""
+	Update the display for the current time and arm the timer for the next
+	change.
+	"""
+	def _tick(self):
+		now = time.monotonic()
+		phase = self.source() if self.source else None
+		if phase and now - phase[1] > phase[2] * STALE_TICKS:
+			phase = None
+
+		if not phase:
+			self._show(None, False)
+			self._arm(now, now + IDLE_POLL)
+			return
+
+		(ticks, last, interval) = phase
+		beat_length = interval * PPQN
+		flash = min(FLASH_LENGTH, beat_length / 2)
+
+		# The first tick of the bar grid is the first beat, so beat n starts
+		# at tick n * PPQN (counting from 0).
+		position = (ticks - 1) + (now - last) / interval
+		beat = int(position // PPQN)
+		start = last + (beat * PPQN - (ticks - 1)) * interval
+
+		lit = now - start < flash
+		if self._show(beat % self.beats, lit):
+			self.last_paint = now
+		self._arm(now, start + flash if lit else start + beat_length)
+
+	def _arm(self, now, when):
+		# never repaint faster than the display can show it
+		when = max(when, self.last_paint + 1.0 / self.max_fps)
+		# rounding up means we wake on, or just after, the beat; a timer firing
+		# early only finds nothing to do and re-arms
+		self.timer.start(max(0, int(math.ceil((when - now) * 1000))))
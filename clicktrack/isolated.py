@@ -0,0 +1,411 @@
+import atexit
+import fcntl
+import multiprocessing
+import os
+import sys
+import threading
+import signal
+import time
+
+from clicktrack import audio
+from clicktrack.dispatcher import ClickRouter, TimedDispatcher
+
+"""
+Process-isolated click engine.
+
+The regular ClickRouter shares an interpreter (and therefore the GIL) with the
+Qt event loop, so a heavy repaint on the GUI side directly delays ticks. The
+IsolatedClickRouter runs a ClickRouter + TimedDispatcher in a dedicated child
+process instead. The GUI talks to it over two channels:
+
+ * a shared memory state block (an array of doubles, see the STATE_* indices
+   below) which the engine updates and the GUI reads without any locking
+ * a one-way command pipe carrying start/stop/tempo/pattern/song commands
+
+The engine deliberately outlives a GUI that dies while the clock is running:
+the pipe is closed but the clock keeps going until the engine is terminated,
+which the next GUI to start does (the engine holds a lock on ENGINE_LOCK_PATH,
+which also holds its pid). An engine that loses its GUI while the clock is
+stopped just exits. On a normal exit, including one on an unhandled exception,
+the GUI shuts its engine down from an atexit handler.
+
+Only the timed (master mode) dispatcher is supported, since MIDI input ports
+opened by the GUI cannot be handed over to another process.
+"""
+
+STATE_TEMPO      = 0
+STATE_MULTIPLIER = 1
+STATE_RUNNING    = 2
+STATE_SONG       = 3
+STATE_TICKS      = 4
+STATE_LAST_TICK  = 5
+STATE_MAX_LATE   = 6
+STATE_HEARTBEAT  = 7
+STATE_BAR_ORIGIN = 8
+STATE_SIZE       = 9
+
+CMD_START = 'start'
+CMD_STOP  = 'stop'
+CMD_TEMPO = 'tempo'
+CMD_SONG  = 'song'
+CMD_PATTERN = 'pattern'
+CMD_CHANGE_SONG = 'change song'
+CMD_QUIT  = 'quit'
+
+ENGINE_LOCK_PATH = '/tmp/piclicktrack-engine.pid'
+# how often the engine checks on the GUI while no commands arrive
+PARENT_POLL = 0.5
+# how long a stale engine gets to exit on SIGTERM before it is killed
+REAP_TIMEOUT = 2.0
+
+"""
+Front-end to the isolated engine. Mirrors the public API of ClickRouter so that
+the GUI can use either one interchangeably.
+"""
+class IsolatedClickRouter:
+	started = False
+	tempo = 120.0
+	multiplier = 1
+	pattern = None
+
+	process = None
+	conn = None
+	state = None
+	watcher = None
+	first_tick = 0
+
+	def __init__(self, backend=None):
+		if backend and backend is not TimedDispatcher:
+			raise IsolationError("Only the timed dispatcher can run isolated")
+
+		self.context = multiprocessing.get_context('spawn')
+		self.state = self.context.RawArray('d', STATE_SIZE)
+		# multiprocessing joins the engine at exit, which would wait forever
+		# for an engine that is still waiting for commands
+		atexit.register(self.close)
+
+	"""
+	Spawn the engine process if it is not already running. The process is kept
+	warm between start/stop cycles so that starting the clock does not have to
+	wait for an interpreter to boot.
+	"""
+	def _ensure_engine(self):
+		if self.process and self.process.is_alive():
+			return
+
+		reap_stale_engine()
+		child_conn, self.conn = self.context.Pipe(duplex=False)
+		self.process = self.context.Process(target=run_engine,
+			args=(child_conn, self.state), name='clicktrack-engine')
+		self.process.start()
+		child_conn.close()
+
+		self._send(CMD_TEMPO, self.tempo, self.multiplier)
+		if self.pattern:
+			self._send(CMD_PATTERN, self.pattern)
+
+	def _send(self, *command):
+		if self.conn:
+			self.conn.send(command)
+
+	"""
+	Start the clock in the engine process. The callback, if given, is run in
+	this process with the number of ticks observed in the shared state block
+	since it last ran, as with ClickCallback.
+	"""
+	def start(self, callback=None):
+		self._ensure_engine()
+		# the tick counter in the state block never resets, so remember where
+		# this run starts
+		self.first_tick = int(self.state[STATE_TICKS])
+		self._send(CMD_START)
+
+		if callback:
+			self.watcher = StateWatcher(self.state, callback)
+			self.watcher.start()
+
+		self.started = True
+
+	def stop(self):
+		self._send(CMD_STOP)
+
+		if self.watcher:
+			self.watcher.stop()
+			self.watcher = None
+
+		self.started = False
+
+	def set_tempo(self, tempo, multiplier=1):
+		self.tempo = tempo
+		self.multiplier = multiplier
+		self._send(CMD_TEMPO, tempo, multiplier)
+
+	"""
+	The engine applies tempo changes at the next tick boundary anyway.
+	"""
+	def retime(self, tempo):
+		self.set_tempo(tempo, self.multiplier)
+
+	def set_pattern(self, pattern):
+		self.pattern = pattern
+		self._send(CMD_PATTERN, pattern)
+
+	def set_song(self, index):
+		self._send(CMD_SONG, index)
+
+	"""
+	Same as ClickRouter.change_song(); the engine waits for the next bar.
+	"""
+	def change_song(self, tempo, multiplier=1, pattern=None):
+		self.tempo = tempo
+		self.multiplier = multiplier
+		if pattern:
+			self.pattern = pattern
+		self._send(CMD_CHANGE_SONG, tempo, multiplier, pattern)
+
+	"""
+	Same as ClickRouter.get_phase(), read from the shared state block.
+	"""
+	def get_phase(self):
+		ticks = int(self.state[STATE_TICKS]) - self.first_tick
+		if not self.started or ticks <= 0:
+			return None
+		return (ticks, self.state[STATE_LAST_TICK], 60.0 / self.state[STATE_TEMPO] / 24.0)
+
+	"""
+	Same as ClickRouter.get_bar_phase(), read from the shared state block.
+	"""
+	def get_bar_phase(self):
+		phase = self.get_phase()
+		if not phase:
+			return None
+		origin = int(self.state[STATE_BAR_ORIGIN]) - self.first_tick
+		return (phase[0] - origin, phase[1], phase[2])
+
+	def set_input_port(self, port):
+		raise IsolationError("The isolated engine does not support MIDI input")
+
+	"""
+	Return a snapshot of the engine's shared state block as a dict.
+	"""
+	def get_stats(self):
+		return {
+			'tempo': self.state[STATE_TEMPO],
+			'multiplier': int(self.state[STATE_MULTIPLIER]),
+			'running': bool(self.state[STATE_RUNNING]),
+			'song': int(self.state[STATE_SONG]),
+			'ticks': int(self.state[STATE_TICKS]),
+			'last_tick': self.state[STATE_LAST_TICK],
+			'max_late': self.state[STATE_MAX_LATE],
+			'heartbeat': self.state[STATE_HEARTBEAT],
+		}
+
+	"""
+	Shut the engine process down. Unlike stop(), this also terminates the
+	child process.
+	"""
+	def close(self):
+		if self.started:
+			self.stop()
+
+		self._send(CMD_QUIT)
+		if self.conn:
+			self.conn.close()
+			self.conn = None
+
+		if self.process:
+			self.process.join(1.0)
+			if self.process.is_alive():
+				self.process.terminate()
+				self.process.join()
+			self.process = None
+
+"""
+Terminate an engine left behind by a GUI that died, so that it doesn't clock
+every port a second time alongside ours.
+"""
+def reap_stale_engine():
+	try:
+		f = open(ENGINE_LOCK_PATH, 'a+')
+	except OSError as e:
+		raise IsolationError("Cannot open %s: %s" % (ENGINE_LOCK_PATH, e))
+
+	with f:
+		if _try_lock(f):
+			fcntl.flock(f, fcntl.LOCK_UN)
+			return
+
+		f.seek(0)
+		try:
+			pid = int(f.read().strip())
+		except ValueError:
+			raise IsolationError("%s is locked by an unknown process" % (ENGINE_LOCK_PATH))
+
+		sys.stderr.write("Stopping a stale click engine (pid %d)\n" % (pid))
+		_kill(pid, signal.SIGTERM)
+		deadline = time.monotonic() + REAP_TIMEOUT
+		while not _try_lock(f):
+			if time.monotonic() > deadline:
+				_kill(pid, signal.SIGKILL)
+				fcntl.flock(f, fcntl.LOCK_EX)
+				break
+			time.sleep(0.05)
+		fcntl.flock(f, fcntl.LOCK_UN)
+
+def _try_lock(f):
+	try:
+		fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except BlockingIOError:
+		return False
+	return True
+
+def _kill(pid, signum):
+	try:
+		os.kill(pid, signum)
+	except ProcessLookupError:
+		pass
+
+"""
+Polls the shared state block for new ticks and runs a callback in the GUI
+process with the number of new ticks.
+"""
+class StateWatcher(threading.Thread):
+	state = None
+	callback = None
+	quit = False
+
+	def __init__(self, state, callback):
+		super(self.__class__, self).__init__()
+		self.daemon = True
+		self.state = state
+		self.callback = callback
+
+	def start(self):
+		self.quit = False
+		super(self.__class__, self).start()
+
+	def run(self):
+		seen = int(self.state[STATE_TICKS])
+		while not self.quit:
+			ticks = int(self.state[STATE_TICKS])
+			if seen < ticks:
+				# like ClickCallback, ticks that arrived since the last poll
+				# are coalesced into one call
+				self.callback(ticks - seen)
+				seen = ticks
+
+			# poll at roughly twice the tick rate
+			tempo = self.state[STATE_TEMPO] or 120.0
+			time.sleep(30.0 / tempo / 24.0)
+
+	def stop(self):
+		self.quit = True
+		self.join()
+
+"""
+ClickRouter running inside the engine process. Publishes tick statistics into
+the shared state block from the timer thread.
+"""
+class EngineRouter(ClickRouter):
+	state = None
+
+	def __init__(self, state):
+		super(EngineRouter, self).__init__(TimedDispatcher)
+		self.state = state
+
+	def click(self, msg='click'):
+		if msg == 'click':
+			now = time.monotonic()
+			state = self.state
+			state[STATE_TICKS] += 1
+			state[STATE_LAST_TICK] = now
+			state[STATE_HEARTBEAT] = now
+			late = now - self.dispatcher.timer.deadline
+			if late > state[STATE_MAX_LATE]:
+				state[STATE_MAX_LATE] = late
+
+		super(EngineRouter, self).click(msg)
+
+	def set_tempo(self, tempo, multiplier=1):
+		super(EngineRouter, self).set_tempo(tempo, multiplier)
+		# also called at the bar where a song change takes effect
+		self.state[STATE_TEMPO] = tempo
+		self.state[STATE_MULTIPLIER] = multiplier
+
+	def _change_song(self, song):
+		super(EngineRouter, self)._change_song(song)
+		# click() has already counted the tick the new bars start on
+		self.state[STATE_BAR_ORIGIN] = self.state[STATE_TICKS] - 1
+
+"""
+Entry point of the engine process.
+"""
+def run_engine(conn, state):
+	# The GUI process owns the terminal; a ^C there must not take the clock
+	# down with it.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+	# held until we exit; the GUI has already reaped any stale engine
+	lock = open(ENGINE_LOCK_PATH, 'a+')
+	if not _try_lock(lock):
+		sys.stderr.write("Another click engine is running\n")
+		return
+	lock.truncate(0)
+	lock.write("%d\n" % (os.getpid()))
+	lock.flush()
+
+	parent = os.getppid()
+	audio.prepare()
+	router = EngineRouter(state)
+
+	while True:
+		state[STATE_HEARTBEAT] = time.monotonic()
+		try:
+			if not conn.poll(PARENT_POLL):
+				if os.getppid() == parent:
+					continue
+				raise EOFError()
+			command = conn.recv()
+		except (EOFError, OSError):
+			# The GUI went away. A running clock keeps going until someone
+			# terminates us (the next GUI does); a stopped one has no reason
+			# to stay.
+			if not router.started:
+				return
+			while True:
+				time.sleep(1.0)
+
+		if command[0] == CMD_START:
+			if not router.started:
+				state[STATE_MAX_LATE] = 0.0
+				state[STATE_BAR_ORIGIN] = state[STATE_TICKS]
+				router.start()
+				state[STATE_RUNNING] = 1.0
+		elif command[0] == CMD_STOP:
+			if router.started:
+				router.stop()
+				state[STATE_RUNNING] = 0.0
+		elif command[0] == CMD_TEMPO:
+			if command[2] != router.multiplier:
+				router.set_tempo(command[1], command[2])
+			else:
+				router.retime(command[1])
+			state[STATE_TEMPO] = command[1]
+			state[STATE_MULTIPLIER] = command[2]
+		elif command[0] == CMD_PATTERN:
+			router.set_pattern(command[1])
+		elif command[0] == CMD_SONG:
+			state[STATE_SONG] = command[1]
+		elif command[0] == CMD_CHANGE_SONG:
+			router.change_song(command[1], command[2], command[3])
+		elif command[0] == CMD_QUIT:
+			if router.started:
+				router.stop()
+				state[STATE_RUNNING] = 0.0
+			return
+
+class IsolationError(Exception):
+	message = ''
+	def __init__(self, message):
+		super(self.__class__, self).__init__()
+		self.message = message
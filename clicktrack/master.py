@@ -1,5 +1,7 @@
 import time
 
+from clicktrack.voices import ClickPattern
+
 """
 Back-end class for representing the clicktrack master
 """
@@ -63,6 +65,18 @@ class ClickMaster:
 	def get_multiplier(self):
 		return self.songs[self.song_index].get_multiplier()
 	
+	"""
+	Get the click pattern of the current song
+	"""
+	def get_pattern(self):
+		return self.songs[self.song_index].get_pattern()
+	
+	"""
+	Set a custom click pattern for the current song
+	"""
+	def set_pattern(self, beats, accents=None):
+		return self.songs[self.song_index].set_pattern(beats, accents)
+	
 	"""
 	Get number of songs - 1
 	"""
@@ -75,6 +89,8 @@ Back-end class for clicktrack songs
 class Song:
 	tempo = 120
 	multiplier = 1
+	beats = 4
+	accents = None
 	
 	def __init__(self):
 		pass
@@ -89,10 +105,33 @@ class Song:
 		return self.tempo
 	
 	def set_multiplier(self, multiplier):
+		if multiplier != self.multiplier:
+			self.accents = None
 		self.multiplier = multiplier
 	
 	def get_multiplier(self):
 		return self.multiplier
+	
+	"""
+	Set the number of beats per bar and, optionally, a custom list of click
+	levels (see ClickPattern). Changing the multiplier afterwards drops the
+	custom levels.
+	"""
+	def set_pattern(self, beats, accents=None):
+		# validate before storing anything
+		try:
+			ClickPattern(beats, self.multiplier, accents)
+		except ValueError as e:
+			raise ClickMasterError(str(e))
+		
+		self.beats = beats
+		self.accents = accents
+	
+	"""
+	The multiplier doubles as the number of clicks per beat.
+	"""
+	def get_pattern(self):
+		return ClickPattern(self.beats, self.multiplier, self.accents)
 
 """
 Tempo detector
@@ -100,22 +139,32 @@ Tempo detector
 class TempoDetector:
 	beats = []
 	
-	def beat(self):
-		self.beats.append(time.monotonic())
+	"""
+	Record a beat. If the caller fell behind and is reporting several beats
+	at once, ticks is the number of beats that have elapsed since the last
+	call. The beat is stamped with the current time unless one is given, e.g.
+	when analyzing a capture.
+	"""
+	def beat(self, ticks=1, now=None):
+		self.beats.append((now if now is not None else time.monotonic(), ticks))
 	
 	def get_tempo(self):
 		if len(self.beats) < 2:
 			raise ClickMasterError('Need at least 2 beats recorded')
 			
 		# remove beats that were recorded more than 5s before the last one
-		while min(self.beats) < max(self.beats) - 5:
-			self.beats.remove(min(self.beats))
+		last = self.beats[-1][0]
+		while self.beats[0][0] < last - 5:
+			self.beats.pop(0)
+		
+		if len(self.beats) < 2:
+			raise ClickMasterError('Need at least 2 beats recorded')
 		
-		deltas = []
+		ticks = 0
 		for i in range(1, len(self.beats)):
-			deltas.append(self.beats[i] - self.beats[i-1])
+			ticks += self.beats[i][1]
 		
-		average = sum(deltas) / len(deltas)
+		average = (last - self.beats[0][0]) / ticks
 		
 		bpm = 60 / average
 		
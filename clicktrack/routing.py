@@ -0,0 +1,137 @@
+"""
+MIDI message routing for thru mode.
+
+A Route selects messages by input, message type and channel, and forwards them
+to a set of outputs, optionally moving them to another channel. Routes are
+compiled into one 256-entry table per input, indexed by status byte, so that
+routing a message costs a single lookup no matter how many routes there are:
+
+	entry = tables[input][status]
+	for (output, new_status) in entry:
+		...
+
+Clock and other realtime messages are never routed; the clock is forwarded by
+the click dispatcher from the designated clock input only.
+"""
+
+# message types, by the high nibble of the status byte (or the full status
+# byte for system messages)
+NOTE_OFF         = 0x80
+NOTE_ON          = 0x90
+POLY_AFTERTOUCH  = 0xA0
+CONTROL_CHANGE   = 0xB0
+PROGRAM_CHANGE   = 0xC0
+AFTERTOUCH       = 0xD0
+PITCH_BEND       = 0xE0
+SYSEX            = 0xF0
+MTC_QUARTER      = 0xF1
+SONG_POSITION    = 0xF2
+SONG_SELECT      = 0xF3
+TUNE_REQUEST     = 0xF6
+
+CHANNEL_TYPES = (NOTE_OFF, NOTE_ON, POLY_AFTERTOUCH, CONTROL_CHANGE,
+	PROGRAM_CHANGE, AFTERTOUCH, PITCH_BEND)
+SYSTEM_TYPES = (SYSEX, MTC_QUARTER, SONG_POSITION, SONG_SELECT, TUNE_REQUEST)
+
+"""
+Everything a merge box would forward.
+"""
+MERGE_TYPES = CHANNEL_TYPES + (SYSEX,)
+
+"""
+One routing rule.
+
+@param list
+	Input indexes the route applies to, or None for all inputs.
+@param list
+	Message types (see the constants above) to forward.
+@param list
+	Source channels (0-15) to forward, or None for all channels. Ignored for
+	system messages.
+@param list
+	Output port indexes to forward to, or None for all outputs.
+@param dict|int
+	Channel remapping: either a dict of source channel => destination channel,
+	or a single destination channel for everything. None keeps the channel.
+
+Channels outside 0-15 raise ValueError; they would otherwise spill into the
+message type bits of the status byte.
+"""
+class Route:
+	inputs = None
+	types = MERGE_TYPES
+	channels = None
+	outputs = None
+	remap = None
+
+	def __init__(self, inputs=None, types=MERGE_TYPES, channels=None, outputs=None, remap=None):
+		self.inputs = inputs
+		self.types = types
+		self.channels = channels
+		self.outputs = outputs
+		self.remap = remap
+
+		check = list(channels) if channels is not None else []
+		if isinstance(remap, dict):
+			check.extend(remap.keys())
+			check.extend(remap.values())
+		elif remap is not None:
+			check.append(remap)
+		for channel in check:
+			if not isinstance(channel, int) or not 0 <= channel <= 15:
+				raise ValueError("MIDI channel must be between 0 and 15, not %r" % (channel,))
+
+	def _destination_channel(self, channel):
+		if self.remap is None:
+			return channel
+		if isinstance(self.remap, dict):
+			return self.remap.get(channel, channel)
+		return self.remap
+
+	"""
+	Yield (status byte, new status byte) for every status byte this route
+	forwards.
+	"""
+	def statuses(self):
+		for kind in self.types:
+			if kind >= 0xF0:
+				yield (kind, kind)
+				continue
+
+			for channel in range(0, 16):
+				if self.channels is not None and channel not in self.channels:
+					continue
+				yield (kind | channel, kind | self._destination_channel(channel))
+
+"""
+Compile routes into per-input lookup tables.
+
+@param list
+	Routes, in order.
+@param int
+	Number of inputs.
+@param dict
+	Output index => object with a route(message) method.
+@return list
+	One 256-entry list per input; each entry is None or a tuple of
+	(output, new status byte) pairs.
+"""
+def compile_routes(routes, num_inputs, outputs):
+	tables = []
+	for index in range(0, num_inputs):
+		table = [[] for status in range(0, 256)]
+		for route in routes:
+			if route.inputs is not None and index not in route.inputs:
+				continue
+
+			targets = [outputs[i] for i in sorted(outputs.keys())
+				if route.outputs is None or i in route.outputs]
+
+			for (status, new_status) in route.statuses():
+				for output in targets:
+					if (output, new_status) not in table[status]:
+						table[status].append((output, new_status))
+
+		tables.append([tuple(entry) if entry else None for entry in table])
+
+	return tables
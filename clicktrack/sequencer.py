@@ -0,0 +1,193 @@
+import time
+
+try:
+	from pyalsa import alsaseq
+except ImportError:
+	alsaseq = None
+
+"""
+Scheduled MIDI output through a sequencer queue.
+
+A SequencerBackend takes realtime messages (clock, start, stop, ...) together
+with the time.monotonic() time they are due, and has something other than
+Python deliver them at that time. SequencerOutput in dispatcher.py uses one
+to keep a window of upcoming ticks queued.
+
+AlsaSequencerBackend uses an ALSA sequencer queue with real-time timestamps,
+so the kernel's timer sends the clock. It needs pyalsa
+(https://github.com/alsa-project/alsa-python). FakeSequencerBackend only
+records what it is asked to do, for trying out the scheduling without
+MIDI hardware.
+"""
+
+"""
+Interface of a sequencer backend.
+"""
+class SequencerBackend:
+	"""
+	Prepare for a run: create the queue and start its clock.
+	"""
+	def start(self):
+		raise NotImplementedError()
+
+	"""
+	Queue a realtime message (status byte) for delivery at a time.monotonic()
+	time. Times in the past are delivered right away.
+	"""
+	def schedule(self, status, when):
+		raise NotImplementedError()
+
+	"""
+	Hand everything scheduled since the last commit to the sequencer.
+	"""
+	def commit(self):
+		pass
+
+	"""
+	Discard every queued message that hasn't been delivered yet.
+	"""
+	def flush(self):
+		raise NotImplementedError()
+
+	"""
+	End the run started by start().
+	"""
+	def stop(self):
+		pass
+
+	def close(self):
+		pass
+
+"""
+Backend for the ALSA sequencer. Creates a client with one output port which
+is connected to every MIDI output in the system, just like the ports
+ClickRouter opens. Like ClickRouter, it looks for outputs again on every
+start, so devices plugged in since are clocked too.
+
+Flushing deletes the queue, which drops everything still scheduled on it, and
+starts a new one. Event times are relative to the start of the queue, so the
+time.monotonic() time each queue was started at is kept as the base.
+"""
+class AlsaSequencerBackend(SequencerBackend):
+	seq = None
+	port = None
+	queue = None
+	base = 0.0
+
+	def __init__(self, client_name='piclicktrack'):
+		if alsaseq is None:
+			raise SequencerError("The ALSA sequencer output needs pyalsa")
+
+		self.event_types = {
+			0xF8: alsaseq.SEQ_EVENT_CLOCK,
+			0xFA: alsaseq.SEQ_EVENT_START,
+			0xFB: alsaseq.SEQ_EVENT_CONTINUE,
+			0xFC: alsaseq.SEQ_EVENT_STOP,
+		}
+
+		self.seq = alsaseq.Sequencer(clientname=client_name,
+			streams=alsaseq.SEQ_OPEN_OUTPUT, mode=alsaseq.SEQ_BLOCK)
+		self.port = self.seq.create_simple_port('clock',
+			alsaseq.SEQ_PORT_TYPE_MIDI_GENERIC | alsaseq.SEQ_PORT_TYPE_APPLICATION,
+			alsaseq.SEQ_PORT_CAP_READ | alsaseq.SEQ_PORT_CAP_SUBS_READ)
+
+	def _connect_outputs(self):
+		writable = alsaseq.SEQ_PORT_CAP_WRITE | alsaseq.SEQ_PORT_CAP_SUBS_WRITE
+		for (client_name, client_id, ports) in self.seq.connection_list():
+			# skip the system client, ourselves and rtmidi's input clients,
+			# which would bounce the clock back into the application
+			if client_id == 0 or client_id == self.seq.client_id or \
+					client_name.startswith('RtMidiIn Client'):
+				continue
+
+			for (port_name, port_id, connections) in ports:
+				info = self.seq.get_port_info(port_id, client_id)
+				if info['capability'] & writable != writable:
+					continue
+
+				try:
+					self.seq.connect_ports((self.seq.client_id, self.port),
+						(client_id, port_id))
+				except alsaseq.SequencerError:
+					# already connected on an earlier start
+					continue
+				print("Connecting sequencer to MIDI output port: %s" % (port_name))
+
+	def start(self):
+		self._connect_outputs()
+		self._start_queue()
+
+	def _start_queue(self):
+		self.queue = self.seq.create_queue()
+		self.seq.start_queue(self.queue)
+		self.seq.drain_output()
+		self.base = time.monotonic()
+
+	def schedule(self, status, when):
+		event = alsaseq.SeqEvent(self.event_types[status])
+		event.queue = self.queue
+		event.timestamp = alsaseq.SEQ_TIME_STAMP_REAL
+		event.timemode = alsaseq.SEQ_TIME_MODE_ABS
+		event.time = max(0.0, when - self.base)
+		event.source = (self.seq.client_id, self.port)
+		event.dest = (alsaseq.SEQ_ADDRESS_SUBSCRIBERS, alsaseq.SEQ_ADDRESS_UNKNOWN)
+		self.seq.output_event(event)
+
+	def commit(self):
+		self.seq.drain_output()
+
+	def flush(self):
+		self.stop()
+		self._start_queue()
+
+	def stop(self):
+		if self.queue is not None:
+			self.seq.stop_queue(self.queue)
+			self.seq.delete_queue(self.queue)
+			self.queue = None
+
+	def close(self):
+		self.stop()
+		self.seq = None
+
+"""
+Backend that delivers nothing. Every message is recorded in events as a
+(status, time) tuple; messages that were due by the time of a flush are
+considered delivered and kept, later ones are removed.
+"""
+class FakeSequencerBackend(SequencerBackend):
+	events = []
+	flushes = 0
+	running = False
+
+	def __init__(self):
+		self.events = []
+		self.flushes = 0
+		self.running = False
+
+	def start(self):
+		self.running = True
+
+	def schedule(self, status, when):
+		self.events.append((status, when))
+
+	def flush(self):
+		now = time.monotonic()
+		self.events = [e for e in self.events if e[1] <= now]
+		self.flushes += 1
+
+	def stop(self):
+		self.running = False
+
+	"""
+	Times of the given message that have been delivered by now.
+	"""
+	def delivered(self, status):
+		now = time.monotonic()
+		return [when for (s, when) in self.events if s == status and when <= now]
+
+class SequencerError(Exception):
+	message = ''
+	def __init__(self, message):
+		super(self.__class__, self).__init__()
+		self.message = message
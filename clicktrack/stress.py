@@ -0,0 +1,302 @@
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import argparse
+
+from clicktrack import audio
+from clicktrack.benchmark import ThreadedBenchmarkRouter, percentile
+
+"""
+Timing stress test for the threaded click engine.
+
+Runs ClickRouter + TimedDispatcher against fake MIDI ports (see benchmark.py)
+while worker processes load the machine, and checks the timing against fixed
+limits and against a stored baseline. Each scenario adds one kind of load:
+
+	idle     no load
+	cpu      one busy loop per CPU
+	memory   processes sweeping through a large buffer, thrashing the caches
+	         and the memory bus
+	disk     a process writing and fsync()ing a scratch file
+	all      cpu, memory and disk together
+	qt       a headless Qt event loop in this process, repainting a
+	         BeatIndicator and running Python work on the GUI thread, i.e.
+	         competing for the interpreter lock like the real GUI does;
+	         the only scenario that needs PyQt, skipped without it
+	audio    the standby audio writer (see audio.py) playing silence in this
+	         process, waking once per device period and competing for the
+	         interpreter lock; skipped if there is no audio device
+
+Measured per scenario, in seconds:
+
+	timer_p99    lateness of the timer ticks against the ideal grid (the
+	             first tick + n * interval, on time.monotonic())
+	latency_p99  lateness of the clock bytes leaving the fake ports
+	drift        mean lateness over the last beat minus that over the first,
+	             i.e. how far the clock has wandered from the ideal grid
+	missing      ticks that should have been sent but weren't
+
+Usage: python3 -m clicktrack.stress [-s SCENARIO] [-d SECONDS] [-t TEMPO]
+	[-p PORTS] [-b BASELINE] [--save-baseline]
+
+The exit status is 1 if any limit is exceeded or any number regressed
+against the baseline, so this can run unattended on the target Pi. The
+default duration of 10 minutes per scenario is what it takes for drift to
+show; use -d for a quick check.
+"""
+
+SCENARIOS = ['idle', 'cpu', 'memory', 'disk', 'all', 'qt', 'audio']
+
+# hard limits, whatever the baseline says
+LIMITS = {
+	'timer_p99': 0.002,
+	'latency_p99': 0.003,
+	'drift': 0.001,
+	'missing': 0,
+}
+
+# A result regresses if it is worse than the baseline by more than this
+# fraction plus the absolute slack, which keeps tiny numbers from failing on
+# noise.
+TOLERANCE = 0.5
+SLACK = 0.0002
+
+DEFAULT_BASELINE = 'clicktrack-stress-baseline.json'
+
+MEMORY_MB = 64
+DISK_CHUNK = 1 << 20
+DISK_FILE_MB = 64
+
+def cpu_load(stop):
+	n = 0
+	while not stop.is_set():
+		for i in range(0, 100000):
+			n += i * i
+
+def memory_load(stop):
+	buf = bytearray(MEMORY_MB << 20)
+	while not stop.is_set():
+		# one write per page
+		for i in range(0, len(buf), 4096):
+			buf[i] = (buf[i] + 1) & 0xFF
+
+def disk_load(stop, directory):
+	chunk = os.urandom(DISK_CHUNK)
+	(fd, path) = tempfile.mkstemp(prefix='clicktrack-stress-', dir=directory)
+	try:
+		written = 0
+		while not stop.is_set():
+			os.write(fd, chunk)
+			os.fsync(fd)
+			written += DISK_CHUNK
+			if written >= DISK_FILE_MB << 20:
+				os.lseek(fd, 0, os.SEEK_SET)
+				written = 0
+	finally:
+		os.close(fd)
+		os.unlink(path)
+
+"""
+Start the load worker processes for a scenario. Returns (stop event,
+processes).
+"""
+def start_load(scenario, directory):
+	stop = multiprocessing.Event()
+	workers = []
+	if scenario in ('cpu', 'all'):
+		for i in range(0, multiprocessing.cpu_count()):
+			workers.append((cpu_load, (stop,)))
+	if scenario in ('memory', 'all'):
+		for i in range(0, max(1, multiprocessing.cpu_count() // 2)):
+			workers.append((memory_load, (stop,)))
+	if scenario in ('disk', 'all'):
+		workers.append((disk_load, (stop, directory)))
+
+	processes = []
+	for (target, args) in workers:
+		process = multiprocessing.Process(target=target, args=args)
+		process.daemon = True
+		process.start()
+		processes.append(process)
+
+	return (stop, processes)
+
+def stop_load(stop, processes):
+	stop.set()
+	for process in processes:
+		process.join(5.0)
+		if process.is_alive():
+			process.terminate()
+
+"""
+Run the GUI thread side of the qt scenario for the given time: a headless
+application showing a BeatIndicator fed by the router, plus a timer that
+keeps the GUI thread busy in Python for part of every frame.
+"""
+def run_qt(router, duration):
+	os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+	from clicktrack.indicator import BeatIndicator, QtWidgets, QtCore
+
+	app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+	indicator = BeatIndicator()
+	indicator.resize(480, 48)
+	indicator.set_source(router.get_bar_phase)
+	indicator.show()
+
+	def busy():
+		# about a third of a 60Hz frame of interpreter work
+		end = time.monotonic() + 0.005
+		while time.monotonic() < end:
+			pass
+		indicator.repaint()
+
+	busy_timer = QtCore.QTimer()
+	busy_timer.timeout.connect(busy)
+	busy_timer.start(16)
+
+	QtCore.QTimer.singleShot(int(duration * 1000), app.quit)
+	app.exec_()
+	busy_timer.stop()
+	indicator.hide()
+
+def run_scenario(scenario, num_ports, tempo, duration, directory):
+	router = ThreadedBenchmarkRouter()
+	router.num_ports = num_ports
+	router.set_tempo(tempo)
+
+	(stop, processes) = start_load(scenario, directory)
+	device = None
+	try:
+		if scenario == 'audio':
+			device = audio.standby()
+			# as a running clock would
+			device.resume()
+		# let the load settle before the clock starts
+		time.sleep(1.0)
+		router.start()
+		if scenario == 'qt':
+			run_qt(router, duration)
+		else:
+			time.sleep(duration)
+		router.stop()
+	finally:
+		stop_load(stop, processes)
+		# so that the writer doesn't load the scenarios after this one
+		if device:
+			device.close()
+
+	interval = 60.0 / tempo / 24.0
+	timer = [t - (router.first_tick + k * interval)
+		for (k, t) in enumerate(router.tick_times)]
+
+	latencies = []
+	for port in router.fake_ports:
+		for (k, t) in enumerate(port.beat_times()):
+			latencies.append(t - (router.first_tick + k * interval))
+
+	beat = 24
+	drift = 0.0
+	if len(timer) >= 2 * beat:
+		drift = sum(timer[-beat:]) / beat - sum(timer[:beat]) / beat
+
+	# the ticks the ideal clock would have sent between the first tick and
+	# the last one we were still running for
+	expected = int((router.tick_times[-1] - router.first_tick) / interval) + 1 \
+		if router.tick_times else 0
+
+	return {
+		'ticks': len(timer),
+		'timer_p99': percentile(timer, 99),
+		'latency_p99': percentile(latencies, 99),
+		'drift': abs(drift),
+		'missing': max(0, expected - len(timer)),
+	}
+
+"""
+Compare a result against the limits and the baseline. Returns a list of
+failure messages.
+"""
+def check(scenario, result, baseline):
+	failures = []
+	for (key, limit) in LIMITS.items():
+		if result[key] > limit:
+			failures.append("%s: %s=%g exceeds the limit of %g" % (scenario, key,
+				result[key], limit))
+
+	if scenario in baseline:
+		for (key, value) in baseline[scenario].items():
+			if key not in LIMITS or key not in result:
+				continue
+			allowed = value * (1 + TOLERANCE) + (SLACK if key != 'missing' else 0)
+			if result[key] > allowed:
+				failures.append("%s: %s=%g regressed from the baseline %g" % (
+					scenario, key, result[key], value))
+
+	return failures
+
+def print_result(scenario, result):
+	print("%-7s ticks=%-6d timer p99=%7.1fus latency p99=%7.1fus drift=%7.1fus missing=%d" % (
+		scenario, result['ticks'], result['timer_p99'] * 1e6,
+		result['latency_p99'] * 1e6, result['drift'] * 1e6, result['missing']))
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Stress test the click timing under load.')
+	parser.add_argument('-s', '--scenario', action='append', choices=SCENARIOS,
+		help='scenario to run (may be repeated; default: all of them)')
+	parser.add_argument('-d', '--duration', type=float, default=600.0,
+		help='seconds to run each scenario for')
+	parser.add_argument('-t', '--tempo', type=float, default=120.0)
+	parser.add_argument('-p', '--ports', type=int, default=4,
+		help='number of fake output ports')
+	parser.add_argument('-b', '--baseline', default=DEFAULT_BASELINE,
+		help='baseline file to compare against')
+	parser.add_argument('--save-baseline', action='store_true',
+		help='store the results as the new baseline instead of comparing')
+	parser.add_argument('--scratch', default=tempfile.gettempdir(),
+		help='directory for the disk load scratch file')
+	args = parser.parse_args(argv)
+
+	baseline = {}
+	if os.path.exists(args.baseline):
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+
+	results = {}
+	failures = []
+	for scenario in (args.scenario or SCENARIOS):
+		if scenario == 'qt':
+			try:
+				importlib.import_module('clicktrack.indicator')
+			except ImportError:
+				print("%-7s skipped, PyQt is not installed" % (scenario))
+				continue
+		elif scenario == 'audio':
+			try:
+				audio.standby()
+			except audio.AudioError as e:
+				print("%-7s skipped, %s" % (scenario, e.message))
+				continue
+
+		result = run_scenario(scenario, args.ports, args.tempo, args.duration,
+			args.scratch)
+		print_result(scenario, result)
+		results[scenario] = result
+		failures.extend(check(scenario, result, {} if args.save_baseline else baseline))
+
+	if args.save_baseline:
+		baseline.update(results)
+		with open(args.baseline, 'w') as f:
+			json.dump(baseline, f, indent=1, sort_keys=True)
+		print("Saved baseline to %s" % (args.baseline))
+
+	for failure in failures:
+		print("FAIL " + failure)
+
+	return 1 if failures else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,271 @@
+import array
+import json
+import os
+import threading
+import time
+
+"""
+Cross-thread tracing for the threaded click engine.
+
+When a tick comes out late it is not obvious where the time went: the timer
+oversleeping, publishing the tick in ClickRouter.click(), a slow send_message()
+on one MIDI output or handing the audible click to the audio device. With a Tracer
+attached (ClickRouter.set_tracer()), every stage records spans and instant
+events into a TraceBuffer owned by its thread. Buffers are preallocated rings
+of arrays, like capture.ClockCapture, so recording never allocates and old
+events are simply overwritten.
+
+The rings can be dumped at any time, and a Tracer with a lateness threshold
+dumps them by itself (from its own thread) when a tick is later than that.
+Dumps hold the last few seconds before the trigger in the Chrome trace-event
+JSON format, which can be opened in Perfetto (https://ui.perfetto.dev) or
+chrome://tracing.
+
+Without a tracer nothing is recorded; each stage only tests an attribute that
+is None.
+"""
+
+# span and event names
+SPAN_SLEEP    = 0
+SPAN_TICK     = 1
+SPAN_PUT      = 2
+SPAN_SEND     = 3
+SPAN_WRITE    = 4
+SPAN_CALLBACK = 5
+EVENT_WAKE    = 6
+EVENT_LATE    = 7
+EVENT_DUMP    = 8
+
+NAMES = [
+	'HrTimer.sleep',
+	'ClickRouter.click',
+	'TickSequence.publish',
+	'send_message',
+	'AudioDevice.play',
+	'callback',
+	'wake',
+	'late tick',
+	'dump',
+]
+
+# what the value recorded with each kind of event means
+ARGS = [
+	None,
+	'late_us',
+	'workers',
+	'status',
+	'bytes',
+	'ticks',
+	'ticks',
+	'late_us',
+	None,
+]
+
+PHASE_SPAN    = 0
+PHASE_INSTANT = 1
+
+DEFAULT_SECONDS = 10.0
+
+# lateness that triggers a dump when tracing from the command line (-T)
+DEFAULT_THRESHOLD = 0.002
+
+# The busiest thread is the timer's, at about four events per tick (a sleep or
+# two, the tick and the publish); twice that leaves room for extra sleeps and
+# late tick markers. The ring is sized for the highest tempo a song can have
+# (see master.Song), so it holds the full DEFAULT_SECONDS at any tempo.
+MAX_TEMPO = 500
+EVENTS_PER_TICK = 8
+# events per second a single thread records at most, at 24 ticks per beat
+EVENT_RATE = MAX_TEMPO * 24 // 60 * EVENTS_PER_TICK
+
+# at most one automatic dump per this many seconds
+TRIGGER_HOLDOFF = 5.0
+
+"""
+Per-thread ring of trace events. Only the owning thread writes to it, or
+threads taking turns under a lock of their own (the failover dispatcher's
+input and flywheel threads); dumps read it from another thread without
+locking, so the event being written at that moment may come out torn.
+"""
+class TraceBuffer:
+	tracer = None
+	name = None
+	capacity = 0
+	count = 0
+
+	def __init__(self, tracer, name, capacity):
+		self.tracer = tracer
+		self.name = name
+		self.capacity = capacity
+		self.count = 0
+		self.kind = array.array('B', bytes(capacity))
+		self.phase = array.array('B', bytes(capacity))
+		self.start = array.array('d', [0.0]) * capacity
+		self.duration = array.array('d', [0.0]) * capacity
+		self.value = array.array('d', [0.0]) * capacity
+
+	def _record(self, kind, phase, start, duration, value):
+		i = self.count % self.capacity
+		self.kind[i] = kind
+		self.phase[i] = phase
+		self.start[i] = start
+		self.duration[i] = duration
+		self.value[i] = value
+		self.count += 1
+
+	"""
+	Record a span from start to end (time.monotonic() stamps).
+	"""
+	def span(self, kind, start, end, value=0.0):
+		self._record(kind, PHASE_SPAN, start, end - start, value)
+
+	def instant(self, kind, stamp, value=0.0):
+		self._record(kind, PHASE_INSTANT, stamp, 0.0, value)
+
+	"""
+	Record a timer tick: the span of the tick, and how late it started
+	relative to its deadline. Ticks later than the tracer's threshold are
+	marked and trigger a dump.
+	"""
+	def tick(self, deadline, start, end):
+		late = start - deadline
+		self._record(SPAN_TICK, PHASE_SPAN, start, end - start, late * 1e6)
+		threshold = self.tracer.threshold
+		if threshold and late > threshold:
+			self._record(EVENT_LATE, PHASE_INSTANT, start, 0.0, late * 1e6)
+			self.tracer.trigger(start)
+
+	"""
+	Events with a start time of at least since, in chronological order, as
+	tuples of (kind, phase, start, duration, value).
+	"""
+	def events(self, since):
+		count = self.count
+		first = count - min(count, self.capacity)
+		events = []
+		for n in range(first, count):
+			i = n % self.capacity
+			if self.start[i] >= since:
+				events.append((self.kind[i], self.phase[i], self.start[i],
+					self.duration[i], self.value[i]))
+		return events
+
+"""
+Owner of the trace buffers.
+
+@param float
+	Seconds of history to keep and dump
+@param float
+	Tick lateness, in seconds, that triggers a dump; None to only dump on
+	request
+@param str
+	Directory automatic dumps are written to
+"""
+class Tracer:
+	seconds = DEFAULT_SECONDS
+	threshold = None
+	directory = '/tmp'
+	dumps = 0
+
+	def __init__(self, seconds=DEFAULT_SECONDS, threshold=None, directory='/tmp'):
+		self.seconds = seconds
+		self.threshold = threshold
+		self.directory = directory
+		self.buffers = []
+		self.lock = threading.Lock()
+		self.pending = threading.Event()
+		self.trigger_time = None
+		self.last_trigger = 0.0
+		self.dumps = 0
+		self.dumper = None
+
+	"""
+	Return the buffer for a thread (or any single writer). Buffers are kept by
+	name, so a worker that is restarted with the clock carries on where the
+	previous one left off.
+	"""
+	def buffer(self, name):
+		with self.lock:
+			for buf in self.buffers:
+				if buf.name == name:
+					return buf
+			buf = TraceBuffer(self, name, int(self.seconds * EVENT_RATE))
+			self.buffers.append(buf)
+			return buf
+
+	"""
+	Ask the dumper thread to write out the events before the given time (now
+	if not given). Cheap enough to call from the timer thread; triggers less
+	than TRIGGER_HOLDOFF apart are ignored.
+	"""
+	def trigger(self, stamp=None):
+		if stamp is None:
+			stamp = time.monotonic()
+		if stamp - self.last_trigger < TRIGGER_HOLDOFF:
+			return
+		self.last_trigger = stamp
+		self.request_dump(stamp)
+
+	"""
+	Same as trigger(), without the holdoff; for dumps on demand.
+	"""
+	def request_dump(self, stamp=None):
+		self.trigger_time = stamp if stamp is not None else time.monotonic()
+		self.pending.set()
+
+	def start(self):
+		if self.dumper:
+			return
+		self.dumper = threading.Thread(target=self._run_dumper, name='trace dumper')
+		self.dumper.daemon = True
+		self.dumper.start()
+
+	def _run_dumper(self):
+		while True:
+			self.pending.wait()
+			self.pending.clear()
+			# let the workers finish what they were doing with the late tick
+			time.sleep(0.1)
+			path = self.dump(until=self.trigger_time)
+			print("Wrote trace to %s" % (path))
+
+	"""
+	Write the last seconds of trace, ending shortly after until, as Chrome
+	trace-event JSON. Returns the path written to.
+	"""
+	def dump(self, path=None, until=None):
+		if until is None:
+			until = time.monotonic()
+		if path is None:
+			self.dumps += 1
+			path = os.path.join(self.directory, 'piclicktrack-trace-%s-%d.json' % (
+				time.strftime('%Y%m%d-%H%M%S'), self.dumps))
+
+		with self.lock:
+			buffers = list(self.buffers)
+
+		since = until - self.seconds
+		pid = os.getpid()
+		events = []
+		for (tid, buf) in enumerate(buffers, 1):
+			events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+				'tid': tid, 'args': {'name': buf.name}})
+			for (kind, phase, start, duration, value) in buf.events(since):
+				event = {'name': NAMES[kind], 'pid': pid, 'tid': tid,
+					'ts': round((start - since) * 1e6, 3)}
+				if phase == PHASE_SPAN:
+					event['ph'] = 'X'
+					event['dur'] = round(duration * 1e6, 3)
+				else:
+					event['ph'] = 'i'
+					event['s'] = 't'
+				if ARGS[kind]:
+					event['args'] = {ARGS[kind]: value}
+				events.append(event)
+
+		events.append({'name': NAMES[EVENT_DUMP], 'ph': 'i', 's': 'g',
+			'pid': pid, 'tid': 0, 'ts': round((until - since) * 1e6, 3)})
+
+		with open(path, 'w') as f:
+			json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+		return path
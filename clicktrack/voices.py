@@ -0,0 +1,316 @@
+import array
+import math
+import os
+import sys
+import threading
+import wave
+
+"""
+Click voice library.
+
+A voice knows how to render three kinds of click: the accented downbeat, a
+normal beat and a subdivision. Rendered clicks are converted once to the
+output device's sample rate, format and channel count, then kept in a cache
+so that the audio thread only ever hands ready-made buffers to the device.
+
+A ClickPattern describes where in the bar those clicks fall. The pattern is
+compiled into a ClickSchedule: a table with one entry per MIDI clock tick in
+the bar, holding either a buffer to play or None.
+"""
+
+VOICE_ACCENT = 'accent'
+VOICE_BEAT   = 'beat'
+VOICE_SUB    = 'sub'
+
+LEVELS = (VOICE_ACCENT, VOICE_BEAT, VOICE_SUB)
+
+FORMAT_U8     = 'U8'
+FORMAT_S16_LE = 'S16_LE'
+FORMAT_S32_LE = 'S32_LE'
+
+# sample width in bytes and full scale value for each supported format
+FORMATS = {
+	FORMAT_U8: (1, 127),
+	FORMAT_S16_LE: (2, 32767),
+	FORMAT_S32_LE: (4, 2147483647),
+}
+
+PPQN = 24
+
+"""
+Synthesized click: a short, exponentially decaying sine burst.
+"""
+class SynthVoice:
+	name = 'synth'
+	length = 0.03
+	# level: (frequency, gain)
+	tones = {
+		VOICE_ACCENT: (1760.0, 1.0),
+		VOICE_BEAT: (1320.0, 0.8),
+		VOICE_SUB: (880.0, 0.5),
+	}
+
+	def __init__(self, name='synth', tones=None, length=0.03):
+		self.name = name
+		self.length = length
+		if tones:
+			self.tones = tones
+
+	"""
+	Render a click as a list of floats in [-1, 1] at the given rate.
+	"""
+	def render(self, level, rate):
+		(freq, gain) = self.tones[level]
+		frames = int(self.length * rate)
+		decay = 5.0 / frames
+		step = 2.0 * math.pi * freq / rate
+		return [gain * math.exp(-n * decay) * math.sin(n * step) for n in range(0, frames)]
+
+"""
+Sample based click. The accent is the same sample pitched up; beats and
+subdivisions differ in gain only.
+"""
+class SampleVoice:
+	name = 'sample'
+	path = None
+	# level: (pitch, gain)
+	shapes = {
+		VOICE_ACCENT: (1.5, 1.0),
+		VOICE_BEAT: (1.0, 0.8),
+		VOICE_SUB: (1.0, 0.45),
+	}
+
+	def __init__(self, path, name=None, shapes=None):
+		self.path = path
+		self.name = name if name else os.path.basename(path)
+		if shapes:
+			self.shapes = shapes
+		self.samples = None
+		self.rate = 0
+
+	def _load(self):
+		if self.samples is None:
+			(self.samples, self.rate) = read_wav(self.path)
+
+	def render(self, level, rate):
+		self._load()
+		(pitch, gain) = self.shapes[level]
+		return [gain * x for x in resample(self.samples, self.rate * pitch, rate)]
+
+"""
+Cache of rendered click buffers, keyed by (voice, rate, format, channels).
+"""
+class VoiceCache:
+	def __init__(self):
+		self.buffers = {}
+		self.lock = threading.Lock()
+
+	"""
+	Return a dict of level => buffer for the given voice and device format,
+	rendering it if necessary.
+	"""
+	def get(self, voice, rate, fmt, channels=1):
+		key = (voice.name, rate, fmt, channels)
+		with self.lock:
+			if key not in self.buffers:
+				rendered = {}
+				for level in LEVELS:
+					rendered[level] = encode(voice.render(level, rate), fmt, channels)
+				self.buffers[key] = rendered
+
+			return self.buffers[key]
+
+	"""
+	Evict everything that was rendered for a different device configuration.
+	"""
+	def configure(self, rate, fmt, channels=1):
+		with self.lock:
+			for key in list(self.buffers.keys()):
+				if key[1:] != (rate, fmt, channels):
+					del self.buffers[key]
+
+	def clear(self):
+		with self.lock:
+			self.buffers = {}
+
+voice_cache = VoiceCache()
+
+"""
+Describes the clicks within a bar.
+
+@param int
+	Beats per bar; the first beat of each bar is accented.
+@param int
+	Clicks per beat, e.g. 2 for eighths, 3 for triplets, 4 for sixteenths.
+	Subdivisions that don't divide 24 are rounded to the nearest clock tick.
+@param list
+	Optional custom pattern: one level (VOICE_ACCENT, VOICE_BEAT, VOICE_SUB
+	or None for a rest) per click in the bar, i.e. beats * subdivision
+	entries. Overrides the default accent scheme.
+"""
+class ClickPattern:
+	beats = 4
+	subdivision = 1
+	accents = None
+
+	def __init__(self, beats=4, subdivision=1, accents=None):
+		if beats < 1 or subdivision < 1:
+			raise ValueError("Beats and subdivision must be at least 1")
+		if accents is not None and len(accents) != beats * subdivision:
+			raise ValueError("Custom pattern needs %d entries" % (beats * subdivision))
+
+		self.beats = beats
+		self.subdivision = subdivision
+		self.accents = accents
+
+	def levels(self):
+		if self.accents is not None:
+			return list(self.accents)
+
+		levels = []
+		for beat in range(0, self.beats):
+			levels.append(VOICE_ACCENT if beat == 0 else VOICE_BEAT)
+			levels.extend([VOICE_SUB] * (self.subdivision - 1))
+		return levels
+
+	"""
+	Return a list with one entry per clock tick in the bar holding the level
+	to play on that tick, or None.
+	"""
+	def ticks(self):
+		table = [None] * (self.beats * PPQN)
+		for (k, level) in enumerate(self.levels()):
+			tick = int(round(k * PPQN / float(self.subdivision)))
+			table[tick % len(table)] = level
+		return table
+
+	def __eq__(self, other):
+		return isinstance(other, ClickPattern) and \
+			(self.beats, self.subdivision, self.accents) == \
+			(other.beats, other.subdivision, other.accents)
+
+"""
+A ClickPattern compiled against a voice and device format: a per-tick table of
+ready-to-write buffers.
+"""
+class ClickSchedule:
+	def __init__(self, pattern, voice, rate, fmt, channels=1):
+		buffers = voice_cache.get(voice, rate, fmt, channels)
+		self.table = [buffers[level] if level else None for level in pattern.ticks()]
+
+	"""
+	Buffer to play on the given tick (counted from the start of the song), or
+	None.
+	"""
+	def at(self, tick):
+		return self.table[tick % len(self.table)]
+
+"""
+Search the system for the bundled click sample.
+"""
+def find_click_file():
+	paths = [
+		os.path.dirname(os.path.realpath(__file__)) + '/data/click.wav',
+		'/usr/local/share/piclicktrack/click.wav',
+		'/usr/share/piclicktrack/click.wav'
+	]
+
+	for p in paths:
+		if os.path.exists(p):
+			return p
+
+	return None
+
+_default_voice = None
+
+"""
+Default voice: the bundled click sample if it can be found and read,
+otherwise a synthesized click. The sample is looked up and decoded once per
+process.
+"""
+def default_voice():
+	global _default_voice
+	if _default_voice is None:
+		_default_voice = _load_default_voice()
+	return _default_voice
+
+def _load_default_voice():
+	path = find_click_file()
+	if not path:
+		sys.stderr.write("click.wav not found in the package data or "
+			"/usr/[local/]share/piclicktrack, using synthesized click\n")
+		return SynthVoice()
+
+	voice = SampleVoice(path, name='click')
+	try:
+		voice._load()
+	except (OSError, EOFError, wave.Error) as e:
+		sys.stderr.write("Cannot read %s (%s), using synthesized click\n" % (path, e))
+		return SynthVoice()
+	return voice
+
+"""
+Read a PCM WAV file. Returns (mono samples as floats in [-1, 1], rate).
+"""
+def read_wav(path):
+	wavfile = wave.open(path, 'rb')
+	(channels, width, rate, frames, comptype, compname) = wavfile.getparams()
+	data = wavfile.readframes(frames)
+	wavfile.close()
+
+	if width == 1:
+		ints = [b - 128 for b in data]
+		scale = 128.0
+	elif width == 3:
+		ints = [int.from_bytes(data[i:i+3], 'little', signed=True)
+			for i in range(0, len(data), 3)]
+		scale = 8388608.0
+	else:
+		ints = array.array('h' if width == 2 else 'i', data)
+		if sys.byteorder == 'big':
+			ints.byteswap()
+		scale = float(1 << (width * 8 - 1))
+
+	samples = []
+	for i in range(0, len(ints), channels):
+		samples.append(sum(ints[i:i+channels]) / (channels * scale))
+
+	return (samples, rate)
+
+"""
+Linear interpolation resampler.
+"""
+def resample(samples, from_rate, to_rate):
+	if from_rate == to_rate:
+		return list(samples)
+
+	ratio = float(from_rate) / to_rate
+	count = int(len(samples) / ratio)
+	out = []
+	last = len(samples) - 1
+	for n in range(0, count):
+		pos = n * ratio
+		i = int(pos)
+		frac = pos - i
+		a = samples[i]
+		b = samples[i + 1] if i < last else a
+		out.append(a + (b - a) * frac)
+	return out
+
+"""
+Convert floats in [-1, 1] to interleaved PCM bytes in the given format.
+"""
+def encode(samples, fmt, channels=1):
+	(width, scale) = FORMATS[fmt]
+	ints = []
+	for x in samples:
+		v = int(round(max(-1.0, min(1.0, x)) * scale))
+		ints.extend([v] * channels)
+
+	if fmt == FORMAT_U8:
+		return bytes([v + 128 for v in ints])
+
+	buf = array.array('h' if width == 2 else 'i', ints)
+	if sys.byteorder == 'big':
+		buf.byteswap()
+	return buf.tobytes()